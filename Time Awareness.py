@@ -5,13 +5,21 @@ author_url: https://github.com/CookSleep
 description: Injects accurate time context into all user messages, including historical ones. It handles various message types and optimizes readability. Supports multiple users and automatically detects user timezone and auth info without manual configuration.
 version: 1.1
 """
+import os
+import re
 import time
+import asyncio
+import bisect
+import sqlite3
 import datetime
+import concurrent.futures
+import threading
+import hashlib
 import logging
 import json
 import zoneinfo
-from typing import Any, Optional, Dict, List, Callable, Union
-from collections import defaultdict
+from typing import Any, AsyncIterator, Optional, Dict, List, Callable, Tuple, Union
+from collections import Counter, OrderedDict, deque
 from pydantic import BaseModel, Field
 
 # --- httpx (needs to be installed via `pip install httpx`) ---
@@ -20,6 +28,18 @@ try:
 except ImportError:
     httpx = None
 
+# --- ijson (optional, enables streaming history parsing via `pip install ijson`) ---
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# --- redis (optional, enables the "redis" ledger backend via `pip install redis`) ---
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # --- Logger Setup ---
 LOGGER = logging.getLogger("TimeAwareness_v1_1")
 LOGGER.setLevel(logging.INFO)
@@ -29,17 +49,737 @@ if not LOGGER.handlers:
     LOGGER.addHandler(handler)
 
 
+class _HistoryCache:
+    """In-memory LRU + TTL cache of parsed chat history, keyed by (user, chat_id)."""
+
+    def __init__(self):
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._message_count = 0
+        # `hits` counts fetches the cached copy saved (the backend reported the chat unchanged), `misses` full downloads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[str, str], ttl: float) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None: return None
+        if ttl > 0 and time.monotonic() - entry["stored_at"] > ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple[str, str], entry: Dict, max_chats: int, max_messages: int) -> None:
+        self._remove(key)
+        entry["stored_at"] = time.monotonic()
+        self._entries[key] = entry
+        self._message_count += len(entry["messages"])
+        while self._entries and (len(self._entries) > max_chats or self._message_count > max_messages):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._message_count = 0
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._message_count -= len(entry["messages"])
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._entries), "messages": self._message_count, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class _LruCache:
+    """Small LRU mapping for per-chat state."""
+
+    def __init__(self):
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        value = self._entries.get(key)
+        if value is not None: self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any, max_entries: int) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(max_entries, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _Metrics:
+    """Per-stage timings, counters and chat-size histograms collected while `metrics_enabled` is on."""
+
+    TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counters: Counter = Counter()
+        self._histograms: Dict[Tuple[str, str], List] = {}
+        self.last_logged = time.monotonic()
+
+    def observe(self, name: str, label: str, value: float, buckets: Tuple = TIME_BUCKETS) -> None:
+        histogram = self._histograms.get((name, label))
+        if histogram is None: histogram = self._histograms[(name, label)] = [buckets, [0] * (len(buckets) + 1), 0.0]
+        histogram[1][bisect.bisect_left(buckets, value)] += 1
+        histogram[2] += value
+
+    def lap(self, stage: str, started: float) -> float:
+        """Records the time since `started` under `stage` and returns the clock reading the next stage starts from."""
+        now = time.perf_counter()
+        self.observe("stage_seconds", stage, now - started)
+        return now
+
+    def snapshot(self, counters: Dict[str, int], gauges: Dict[str, int]) -> Dict:
+        """Counters and gauges plus cumulative histogram buckets, keyed `name` or `name.label`."""
+        histograms = {}
+        for (name, label), (buckets, counts, total) in sorted(self._histograms.items()):
+            cumulative: Dict[str, int] = {}
+            running = 0
+            for bound, count in zip((*buckets, "+Inf"), counts):
+                running += count
+                cumulative[str(bound)] = running
+            histograms[f"{name}.{label}" if label else name] = {"count": running, "sum": round(total, 6), "buckets": cumulative}
+        return {"counters": {**self.counters, **counters}, "gauges": gauges, "histograms": histograms}
+
+    @staticmethod
+    def to_prometheus(snapshot: Dict, namespace: str = "time_awareness") -> str:
+        """Renders a snapshot in the Prometheus text exposition format. Histogram labels are exported as `stage`."""
+        lines: List[str] = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {namespace}_{name}_total counter", f"{namespace}_{name}_total {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {namespace}_{name} gauge", f"{namespace}_{name} {value}"]
+        declared = set()
+        for key, histogram in snapshot["histograms"].items():
+            name, _, label = key.partition(".")
+            metric = f"{namespace}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            labels = f'stage="{label}",' if label else ""
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {count}')
+            labels = f'{{stage="{label}"}}' if label else ""
+            lines += [f"{metric}_sum{labels} {histogram['sum']}", f"{metric}_count{labels} {histogram['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        self.counters.clear()
+        self._histograms.clear()
+
+
+class _ChatDocumentReducer:
+    """Builds a reduced chat document from ijson events, keeping only what the filter reads.
+
+    Every message keeps its role, timestamp and parentId, and user messages also keep their text. `currentId` and
+    `updated_at` are kept too. Everything else (images, files, assistant output) is dropped while it streams by.
+    """
+
+    def __init__(self):
+        self._messages: Dict[str, Dict] = {}
+        self._history: Dict[str, Any] = {"messages": self._messages, "currentId": None}
+        self.document: Dict[str, Any] = {"updated_at": None, "chat": {"history": self._history}}
+        self._message: Optional[Dict] = None
+        self._part: Optional[Dict] = None
+        self._paths = ("",) * 8
+
+    def feed(self, events: List[Tuple[str, str, Any]]) -> None:
+        messages, history, document = self._messages, self._history, self.document
+        message, part = self._message, self._part
+        base, role_p, timestamp_p, parent_p, content_p, item_p, item_type_p, item_text_p = self._paths
+        for prefix, event, value in events:
+            if message is not None:
+                if prefix == base:
+                    if event in ("start_map", "map_key"): continue
+                    if message.get("role") != "user": message.pop("content", None)
+                    message = None
+                elif prefix == role_p: message["role"] = value
+                elif prefix == timestamp_p: message["timestamp"] = value
+                elif prefix == parent_p: message["parentId"] = value
+                elif prefix == content_p:
+                    if event == "string": message["content"] = value
+                    elif event == "start_array": message["content"] = []
+                elif prefix == item_p:
+                    if event == "start_map": part = {}
+                    elif event == "end_map" and part is not None:
+                        if part.get("type") == "text" and isinstance(message.get("content"), list): message["content"].append(part)
+                        part = None
+                elif part is not None and prefix == item_type_p: part["type"] = value
+                elif part is not None and prefix == item_text_p: part["text"] = value
+                continue
+
+            if prefix == "chat.history.messages" and event == "map_key":
+                message = messages[value] = {}
+                base = f"chat.history.messages.{value}"
+                role_p, timestamp_p, parent_p, content_p = f"{base}.role", f"{base}.timestamp", f"{base}.parentId", f"{base}.content"
+                item_p = f"{content_p}.item"
+                item_type_p, item_text_p = f"{item_p}.type", f"{item_p}.text"
+            elif prefix == "chat.history.currentId":
+                history["currentId"] = value
+            elif prefix == "updated_at":
+                document["updated_at"] = value
+        self._message, self._part = message, part
+        self._paths = (base, role_p, timestamp_p, parent_p, content_p, item_p, item_type_p, item_text_p)
+
+
+class _ChatDocumentParser:
+    """Feeds a chat document through ijson into a `_ChatDocumentReducer` one chunk at a time."""
+
+    def __init__(self):
+        self._reducer = _ChatDocumentReducer()
+        self._events = ijson.sendable_list()
+        self._parser = ijson.parse_coro(self._events, use_float=True)
+
+    def send(self, chunk: bytes) -> None:
+        self._parser.send(chunk)
+        self._reducer.feed(self._events)
+        del self._events[:]
+
+    def close(self) -> Dict:
+        self._parser.close()
+        self._reducer.feed(self._events)
+        return self._reducer.document
+
+
+async def _stream_chat_document(chunks: AsyncIterator[bytes], offload: Optional[Callable] = None) -> Dict:
+    """Reduces a chat document as its chunks arrive, so the full JSON is never held in memory.
+
+    With `offload`, each chunk is parsed on the worker thread while the next one downloads, so at most one received
+    chunk waits for the worker.
+    """
+    parser = _ChatDocumentParser()
+    if offload is None:
+        async for chunk in chunks: parser.send(chunk)
+        return parser.close()
+    parsing = None
+    try:
+        async for chunk in chunks:
+            if parsing is not None: await parsing
+            parsing = asyncio.ensure_future(offload(parser.send, chunk))
+        if parsing is not None: await parsing
+    except BaseException:
+        # Nothing reads the parser once the download fails, so the chunk still on the worker can be abandoned
+        if parsing is not None: parsing.cancel()
+        raise
+    return await offload(parser.close)
+
+
+class _MissingAuthToken(Exception):
+    """Raised when the chat history has to be fetched over HTTP but the request carries no JWT."""
+
+
+class _CircuitOpen(Exception):
+    """Raised instead of fetching while the history circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """Opens after `threshold` consecutive failed or slow calls and rejects calls until the cool-down has passed."""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if time.monotonic() < self.open_until:
+            self.rejected += 1
+            return False
+        return True
+
+    def record(self, ok: bool, threshold: int, cooldown: float) -> None:
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        # After the cool-down the failure count is kept, so a single failed trial call re-opens the circuit
+        if threshold > 0 and self.failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """Whether a failed fetch says the history backend is unhealthy: transport errors, timeouts and 5xx responses.
+
+    A 4xx (a deleted chat, or a temporary one the backend never had) is a prompt answer from a healthy backend.
+    """
+    if isinstance(error, (asyncio.TimeoutError, asyncio.CancelledError)): return True
+    if httpx is None: return False
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class _SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight task whose result or error every caller receives."""
+
+    def __init__(self):
+        self._calls: Dict[Any, List] = {}
+        self.coalesced = 0
+
+    async def run(self, key: Any, factory: Callable) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = [asyncio.ensure_future(factory()), 0]
+            call[0].add_done_callback(lambda task, key=key, call=call: self._finish(key, call, task))
+        else:
+            self.coalesced += 1
+        call[1] += 1
+        try:
+            # shield() keeps one caller's cancellation from cancelling the shared task for the others
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                # unregister right away so a caller arriving before the cancellation lands starts a fresh fetch
+                if self._calls.get(key) is call: del self._calls[key]
+                call[0].cancel()
+
+    def _finish(self, key: Any, call: List, task: "asyncio.Future") -> None:
+        if self._calls.get(key) is call: del self._calls[key]
+        if not task.cancelled(): task.exception()
+
+    def cancel_all(self) -> None:
+        for task, _ in list(self._calls.values()): task.cancel()
+
+
+class _HistoryProvider:
+    """Loads a chat document. `fetch` returns `(data, etag)` (`data` is None when unchanged since `etag`), or None if the chat isn't available.
+
+    Providers that wait on a remote response call `on_first_byte` once it starts arriving.
+    """
+
+    name = "base"
+    bytes_read = 0
+
+    async def fetch(self, chat_id: str, user_id: Optional[str], jwt_token: Optional[str], etag: Optional[str], on_first_byte: Optional[Callable[[], None]] = None) -> Optional[Tuple[Optional[Dict], Optional[str]]]:
+        raise NotImplementedError
+
+
+class _HttpHistoryProvider(_HistoryProvider):
+    """Reads the chat through the Open WebUI REST API (`/api/v1/chats/{chat_id}`)."""
+
+    name = "http"
+    # Large enough that handing a chunk to the worker thread costs little next to parsing it
+    _OFFLOAD_CHUNK_BYTES = 65536
+
+    def __init__(self, get_client: Callable, streaming_enabled: Callable[[], bool], offload_min_bytes: Callable[[], int], offload: Callable):
+        self._get_client = get_client
+        self._streaming_enabled = streaming_enabled
+        self._offload_min_bytes = offload_min_bytes
+        self._offload = offload
+
+    async def fetch(self, chat_id, user_id, jwt_token, etag, on_first_byte=None):
+        headers = {"Authorization": f"Bearer {jwt_token}"}
+        if etag: headers["If-None-Match"] = etag
+        client = await self._get_client()
+        async with client.stream("GET", f"/api/v1/chats/{chat_id}", headers=headers) as response:
+            if on_first_byte is not None: on_first_byte()
+            if response.status_code == 304: return None, etag
+            response.raise_for_status()
+            threshold = self._offload_min_bytes()
+            try:
+                if ijson is None or not self._streaming_enabled():
+                    await response.aread()
+                    if threshold > 0 and len(response.content) >= threshold:
+                        return await self._offload(response.json), response.headers.get("etag")
+                    return response.json(), response.headers.get("etag")
+                if threshold > 0 and int(response.headers.get("content-length") or 0) >= threshold:
+                    return await _stream_chat_document(response.aiter_bytes(self._OFFLOAD_CHUNK_BYTES), self._offload), response.headers.get("etag")
+                return await _stream_chat_document(response.aiter_bytes()), response.headers.get("etag")
+            finally:
+                self.bytes_read += response.num_bytes_downloaded
+
+
+class _SqliteHistoryProvider(_HistoryProvider):
+    """Reads `chat.history` straight from Open WebUI's SQLite database, skipping the HTTP loopback."""
+
+    name = "sqlite"
+    _ETAG_PREFIX = "sqlite:"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def default_path() -> str:
+        database_url = os.environ.get("DATABASE_URL", "")
+        if database_url.startswith("sqlite:///"):
+            return database_url[len("sqlite:///"):]
+        return os.path.join(os.environ.get("DATA_DIR", "data"), "webui.db")
+
+    def _read(self, chat_id: str, user_id: str, known_updated_at: Optional[str]) -> Optional[Tuple[Any, Optional[Dict], int]]:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                "SELECT updated_at, CASE WHEN CAST(updated_at AS TEXT) = ? THEN NULL ELSE json_extract(chat, '$.history') END FROM chat WHERE id = ? AND user_id = ?",
+                (known_updated_at, chat_id, user_id),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None: return None
+        updated_at, history_json = row
+        if history_json is None: return updated_at, None, 0
+        return updated_at, json.loads(history_json), len(history_json)
+
+    async def fetch(self, chat_id, user_id, jwt_token, etag, on_first_byte=None):
+        if not user_id or not os.path.exists(self.path): return None
+        known_updated_at = etag[len(self._ETAG_PREFIX):] if etag and etag.startswith(self._ETAG_PREFIX) else None
+        row = await asyncio.to_thread(self._read, chat_id, user_id, known_updated_at)
+        if row is None: return None
+        updated_at, history, size = row
+        new_etag = f"{self._ETAG_PREFIX}{updated_at}"
+        if history is None: return None, new_etag
+        self.bytes_read += size
+        return {"id": chat_id, "updated_at": updated_at, "chat": {"history": history}}, new_etag
+
+
+# Locale tables shared by the English and Chinese builds; each build only differs in `_LOCALE`
+_LOCALE = "en"
+_WEEKDAY_NAMES = {
+    "en": ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"),
+    "zh": ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"),
+}
+_DATE_PATTERNS = {"ISO": "{0:04d}-{1:02d}-{2:02d}", "DMY_SLASH": "{2:02d}/{1:02d}/{0:04d}", "MDY_SLASH": "{1:02d}/{2:02d}/{0:04d}", "DMY_DOT": "{2:02d}.{1:02d}.{0:04d}"}
+
+
+class _TimeFormatter:
+    """Formats time prefixes for one (timezone, date_format, locale). The full-date part is memoized per calendar day."""
+
+    __slots__ = ("tz", "_date_pattern", "_weekdays", "_day_heads")
+    _MAX_DAYS = 4096
+
+    def __init__(self, tz: datetime.tzinfo, date_format: str, locale: str):
+        self.tz = tz
+        self._date_pattern = _DATE_PATTERNS.get(date_format, _DATE_PATTERNS["ISO"])
+        self._weekdays = _WEEKDAY_NAMES.get(locale, _WEEKDAY_NAMES["en"])
+        self._day_heads: Dict[datetime.date, str] = {}
+
+    def localize(self, timestamps: List[Optional[float]]) -> List[Optional[datetime.datetime]]:
+        tz = self.tz
+        fromtimestamp = datetime.datetime.fromtimestamp
+        return [fromtimestamp(timestamp, tz) if timestamp is not None else None for timestamp in timestamps]
+
+    def prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
+        time_str = f"{dt_object.hour:02d}:{dt_object.minute:02d}:{dt_object.second:02d}"
+        if not is_full_format: return f"[{time_str}]"
+        day = dt_object.date()
+        head = self._day_heads.get(day)
+        if head is None:
+            if len(self._day_heads) >= self._MAX_DAYS: self._day_heads.clear()
+            head = self._day_heads[day] = f"[{self._date_pattern.format(day.year, day.month, day.day)}, {self._weekdays[day.weekday()]}, "
+        return f"{head}{time_str}]"
+
+
+def _format_offset(seconds: float) -> str:
+    """Compact relative offset such as "[+45s]", "[+3m]" or "[+2h5m]"."""
+    seconds = int(seconds)
+    if seconds < 60: return f"[+{seconds}s]"
+    hours, minutes = divmod(seconds // 60, 60)
+    if not hours: return f"[+{minutes}m]"
+    return f"[+{hours}h{minutes}m]" if minutes else f"[+{hours}h]"
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token), good enough for budgeting prefixes."""
+    return (len(text) + 3) // 4
+
+
+_FIRST_NON_SPACE = re.compile(r"\S")
+
+
+def _content_digest(content: Union[str, list, None]) -> bytes:
+    """16-byte digest of a message's text, hashing multi-part content part by part instead of joining it first."""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(content, str):
+        digest.update(content.encode("utf-8", "surrogatepass"))
+    elif isinstance(content, list):
+        first = True
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                if not first: digest.update(b"\n")
+                digest.update((part.get("text") or "").encode("utf-8", "surrogatepass"))
+                first = False
+    return digest.digest()
+
+
+def _digest_user_messages(messages: List[dict]) -> Tuple[Dict[int, bytes], set, Dict[int, bytes]]:
+    """Digests of the user messages by index, the indices of those that already start with "[", and a branch fingerprint for each user message.
+
+    The fingerprint covers the message and every user and assistant message before it (with its id when the request
+    carries one), so the same text reached through an edited branch of the chat gets a different fingerprint.
+    """
+    digests: Dict[int, bytes] = {}
+    bracketed = set()
+    fingerprints: Dict[int, bytes] = {}
+    chain = b""
+    for i, message in enumerate(messages):
+        role = message.get("role")
+        if role != "user" and role != "assistant": continue
+        content = message.get("content")
+        digest = _content_digest(content)
+        chain = hashlib.blake2b(chain + role.encode() + digest + str(message.get("id") or "").encode(), digest_size=16).digest()
+        if role == "user":
+            digests[i] = digest
+            fingerprints[i] = chain
+            if _content_starts_with_bracket(content): bracketed.add(i)
+    return digests, bracketed, fingerprints
+
+
+def _content_starts_with_bracket(content: Union[str, list, None]) -> bool:
+    if isinstance(content, str):
+        match = _FIRST_NON_SPACE.search(content)
+        return match is not None and match.group() == "["
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                match = _FIRST_NON_SPACE.search(part.get("text") or "")
+                if match is not None: return match.group() == "["
+    return False
+
+
+class _TimestampIndex:
+    """Maps content digests to their timestamps in chronological order. Each duplicate is consumed in O(1)."""
+
+    __slots__ = ("_slots",)
+    # Stands for a missing slot, since a message's timestamp can itself be None
+    _MISSING = object()
+
+    def __init__(self, entries=()):
+        # A digest seen once maps straight to its timestamp; only repeated texts pay for a deque
+        self._slots: Dict[bytes, Any] = {}
+        for timestamp, digest in sorted(entries, key=lambda item: item[0] or 0):
+            self.add(digest, timestamp)
+
+    def add(self, digest: bytes, timestamp: Optional[float]) -> None:
+        slot = self._slots.get(digest, self._MISSING)
+        if slot is self._MISSING:
+            self._slots[digest] = timestamp
+        elif isinstance(slot, deque):
+            slot.append(timestamp)
+        else:
+            self._slots[digest] = deque((slot, timestamp))
+
+    def pop(self, digest: bytes) -> Optional[float]:
+        slot = self._slots.get(digest, self._MISSING)
+        if slot is self._MISSING: return None
+        if not isinstance(slot, deque):
+            del self._slots[digest]
+            return slot
+        timestamp = slot.popleft()
+        if not slot: del self._slots[digest]
+        return timestamp
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class _TimestampLedger:
+    """SQLite ledger of the timestamps the filter has stamped, keyed by (user, chat_id, branch fingerprint).
+
+    The WAL-mode file is shared by every worker process on the host, so a timestamp stamped by one worker is known to all.
+
+    A fingerprint recorded again with a different time belongs to two messages with the same text and the same
+    history (a message edited to the same text, or one re-sent to regenerate its reply). It is then marked
+    ambiguous, and `lookup` reports it as None so the caller resolves it from the chat history instead.
+    """
+
+    # Recordings of one fingerprint closer than this are the same message (e.g. multi-model fan-out)
+    SAME_MESSAGE_SECONDS = 5.0
+    _SCHEMA_VERSION = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._last_compaction = 0.0
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(os.environ.get("DATA_DIR", "data"), "time_awareness_ledger.db")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self._SCHEMA_VERSION:
+                # Entries of the first version were keyed by text occurrence, which can't be told apart by branch
+                conn.execute("DROP TABLE IF EXISTS stamps")
+                conn.execute(f"PRAGMA user_version = {self._SCHEMA_VERSION}")
+            conn.execute("CREATE TABLE IF NOT EXISTS stamps (user_id TEXT NOT NULL, chat_id TEXT NOT NULL, fingerprint BLOB NOT NULL, timestamp REAL NOT NULL, ambiguous INTEGER NOT NULL DEFAULT 0, recorded_at REAL NOT NULL)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS stamps_key ON stamps (user_id, chat_id, fingerprint)")
+            conn.execute("CREATE INDEX IF NOT EXISTS stamps_recorded_at ON stamps (recorded_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def lookup(self, user_id: str, chat_id: str) -> Dict[bytes, Optional[float]]:
+        with self._lock:
+            rows = self._connect().execute("SELECT fingerprint, timestamp, ambiguous FROM stamps WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)).fetchall()
+        return {fingerprint: None if ambiguous else timestamp for fingerprint, timestamp, ambiguous in rows}
+
+    @classmethod
+    def should_record(cls, known: Dict[bytes, Optional[float]], fingerprint: bytes, timestamp: float) -> bool:
+        """Whether `timestamp` is worth recording: its fingerprint is missing from `known` (a `lookup` result), or known with a clearly different time."""
+        if fingerprint not in known: return True
+        recorded = known[fingerprint]
+        return recorded is not None and abs(recorded - timestamp) > cls.SAME_MESSAGE_SECONDS
+
+    def record(self, user_id: str, chat_id: str, entries: List[Tuple[bytes, float]]) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT INTO stamps (user_id, chat_id, fingerprint, timestamp, recorded_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, chat_id, fingerprint) DO UPDATE SET ambiguous = 1, recorded_at = excluded.recorded_at WHERE abs(stamps.timestamp - excluded.timestamp) > ?",
+                [(user_id, chat_id, fp, ts, now, self.SAME_MESSAGE_SECONDS) for fp, ts in entries],
+            )
+            conn.commit()
+
+    def compact(self, retention_days: float, max_entries: int, interval: float = 3600.0) -> int:
+        """Drops entries older than the retention window and trims the oldest beyond `max_entries`. Runs at most once per `interval` seconds."""
+        now = time.time()
+        if now - self._last_compaction < interval: return 0
+        self._last_compaction = now
+        with self._lock:
+            conn = self._connect()
+            removed = 0
+            if retention_days > 0:
+                removed += conn.execute("DELETE FROM stamps WHERE recorded_at < ?", (now - retention_days * 86400,)).rowcount
+            if max_entries > 0:
+                removed += conn.execute("DELETE FROM stamps WHERE rowid IN (SELECT rowid FROM stamps ORDER BY recorded_at DESC LIMIT -1 OFFSET ?)", (max_entries,)).rowcount
+            conn.commit()
+            if removed: conn.execute("PRAGMA incremental_vacuum")
+        return removed
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _RedisTimestampLedger(_TimestampLedger):
+    """Timestamp ledger in a Redis-compatible server, shared by workers spread over several hosts. Calls block, so they run in a worker thread.
+
+    Each chat is one hash from fingerprint to timestamp, where an empty value marks an ambiguous fingerprint. Recordings run as one
+    server-side script, so two workers recording the same fingerprint can't lose the ambiguity. A chat expires `retention_days`
+    after its last recording; the total size is bounded by the server's `maxmemory` policy.
+    """
+
+    _KEY_PREFIX = "time_awareness:ledger:"
+    # KEYS[1]: the chat's hash; ARGV: TTL in seconds (0 = none), SAME_MESSAGE_SECONDS, then fingerprint and timestamp pairs
+    _RECORD_SCRIPT = """
+local same = tonumber(ARGV[2])
+for i = 3, #ARGV, 2 do
+    local recorded = redis.call('HGET', KEYS[1], ARGV[i])
+    if not recorded then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    elseif recorded ~= '' and math.abs(tonumber(recorded) - tonumber(ARGV[i + 1])) > same then
+        redis.call('HSET', KEYS[1], ARGV[i], '')
+    end
+end
+if tonumber(ARGV[1]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+"""
+
+    def __init__(self, url: str, retention_days: float = 0.0):
+        self.url = url
+        self.retention_days = retention_days
+        self._client = None
+        self._record_script = None
+
+    def _connect(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url, socket_timeout=2.0, socket_connect_timeout=2.0)
+            self._record_script = self._client.register_script(self._RECORD_SCRIPT)
+        return self._client
+
+    def _key(self, user_id: str, chat_id: str) -> str:
+        return f"{self._KEY_PREFIX}{user_id}:{chat_id}"
+
+    def lookup(self, user_id, chat_id):
+        rows = self._connect().hgetall(self._key(user_id, chat_id))
+        return {fingerprint: float(timestamp) if timestamp else None for fingerprint, timestamp in rows.items()}
+
+    def record(self, user_id, chat_id, entries):
+        self._connect()
+        args: List[Any] = [int(self.retention_days * 86400), self.SAME_MESSAGE_SECONDS]
+        for fingerprint, timestamp in entries: args += [fingerprint, repr(float(timestamp))]
+        self._record_script(keys=[self._key(user_id, chat_id)], args=args)
+
+    def compact(self, retention_days, max_entries, interval=3600.0):
+        """Nothing to do: chats expire through their key TTL, and the server's `maxmemory` policy bounds the size."""
+        return 0
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
 class Filter:
     class Valves(BaseModel):
         api_base_url: str = Field(default="http://127.0.0.1:8080", description="The base URL of your Open WebUI backend.")
         date_format: str = Field(default="ISO", description='The date format. E.g., "ISO" (2025-06-13), "DMY_SLASH" (13/06/2025), "MDY_SLASH" (06/13/2025), "DMY_DOT" (13.06.2025).')
         debug_print_request: bool = Field(default=False, description="Log detailed debugging information and performance metrics.")
+        http_max_connections: int = Field(default=20, description="Maximum number of concurrent connections the shared HTTP client keeps to the backend.")
+        http_max_keepalive_connections: int = Field(default=10, description="Maximum number of idle keep-alive connections kept in the pool.")
+        http_keepalive_expiry: float = Field(default=30.0, description="Seconds an idle keep-alive connection stays in the pool before being closed.")
+        http_connect_timeout: float = Field(default=5.0, description="Timeout in seconds for establishing a connection to the backend.")
+        http_read_timeout: float = Field(default=10.0, description="Timeout in seconds for reading the chat history response.")
+        streaming_parse: bool = Field(default=True, description="Stream the chat history response and keep only the fields the filter needs instead of loading images and assistant output into memory. Requires `ijson`; without it the full JSON is loaded.")
+        history_provider: str = Field(default="http", description='Where chat history is read from. "http" calls the Open WebUI API; "sqlite" reads Open WebUI\'s SQLite database directly and falls back to "http" when that isn\'t possible.')
+        database_path: str = Field(default="", description="Path to Open WebUI's SQLite database (webui.db) for the \"sqlite\" provider. Empty derives it from DATABASE_URL or DATA_DIR.")
+        ledger_enabled: bool = Field(default=False, description="Record every stamped timestamp in a ledger shared by all worker processes (see `ledger_backend`) so later turns, on whichever worker, resolve them there instead of fetching the chat history. Entries are keyed by the message and everything before it, so edited branches don't share them.")
+        ledger_backend: str = Field(default="sqlite", description='Where the ledger is kept. "sqlite" uses a local file at `ledger_path`, shared by the workers of one host; "redis" uses the server at `ledger_redis_url`, shared across hosts.')
+        ledger_path: str = Field(default="", description="Path of the \"sqlite\" ledger database. Empty stores it as time_awareness_ledger.db in DATA_DIR.")
+        ledger_redis_url: str = Field(default="redis://localhost:6379/0", description="Connection URL of the \"redis\" ledger (requires `pip install redis`).")
+        ledger_retention_days: float = Field(default=90.0, description="Ledger entries older than this many days are removed. 0 keeps them forever.")
+        ledger_max_entries: int = Field(default=1000000, description="Maximum number of ledger entries; the oldest are removed first. 0 means unlimited.")
+        incremental_injection: bool = Field(default=False, description="Remember how far each chat has already been resolved so later turns only process newly appended messages. A remembered message is reused while the messages after it are unchanged and its id still matches the chat history. Unless the request carries message ids or the ledger is enabled, each turn still fetches the chat history to check the ids.")
+        history_latency_budget: float = Field(default=3.0, description="Seconds each request waits for chat history before degrading to stamping only the current message. A failed fetch degrades the same way. 0 waits without limit.")
+        circuit_breaker_failures: int = Field(default=3, description="Consecutive failed or slow history fetches after which fetches are paused. Only connection errors, timeouts and 5xx responses count as failures. 0 disables the circuit breaker.")
+        circuit_breaker_slow_seconds: float = Field(default=2.0, description="A history fetch whose response takes longer than this many seconds to start arriving counts as a failure.")
+        circuit_breaker_cooldown_seconds: float = Field(default=30.0, description="Seconds history fetches stay paused once the circuit breaker opens.")
+        error_notification_interval: float = Field(default=60.0, description="Minimum seconds between two error notifications to the same user. 0 notifies every time.")
+        offload_min_messages: int = Field(default=2000, description="Chats with at least this many messages are parsed and indexed in a worker thread, so large histories don't block the event loop other requests share. 0 keeps everything on the event loop.")
+        offload_min_bytes: int = Field(default=1000000, description="Chat history responses of at least this many bytes are decoded in a worker thread instead of on the event loop. With streaming_parse each chunk is parsed there as it arrives; otherwise the response is downloaded first. 0 never offloads.")
+        metrics_enabled: bool = Field(default=False, description="Collect per-stage timings, counters and chat-size histograms. Independent of `debug_print_request`; costs next to nothing while off.")
+        metrics_log_interval: float = Field(default=300.0, description="Seconds between two metrics snapshots written to the log. 0 never logs them (they stay available through `metrics_snapshot()`).")
+        metrics_log_format: str = Field(default="json", description='Format of the logged metrics snapshot: "json" (one structured line) or "prometheus" (text exposition format).')
+        prefix_compaction: str = Field(default="off", description='Spend fewer tokens on time prefixes of past messages. "off" stamps every user message; "last_n" stamps only the last `prefix_compaction_last_n` past messages; "minute_runs" stamps only the first of consecutive messages sent within the same minute; "relative" writes offsets from the previous message (e.g. "[+3m]") after each day\'s full date. Outside "off", the current message always carries its full date.')
+        prefix_compaction_last_n: int = Field(default=20, description='Number of past user messages that keep their time prefix in "last_n" mode.')
+        prefix_token_budget: int = Field(default=0, description="Maximum estimated tokens (about 4 characters each) spent on time prefixes of past messages; the oldest prefixes are dropped first. 0 means no limit.")
+        history_cache_enabled: bool = Field(default=True, description="Cache parsed chat history in memory. Every turn that needs history still revalidates it with the backend, but skips re-parsing known messages, and the download too when the backend reports the chat unchanged.")
+        history_cache_ttl_seconds: float = Field(default=600.0, description="Seconds a cached chat history stays valid before it is fetched again. 0 disables expiry.")
+        history_cache_max_chats: int = Field(default=256, description="Maximum number of chats kept in the history cache.")
+        history_cache_max_messages: int = Field(default=50000, description="Maximum total number of user messages kept in the history cache across all chats.")
 
     def __init__(self):
         self.valves = self.Valves()
         self.toggle = True
         self.icon = "data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHdpZHRoPSIyNCIgaGVpZ2h0PSIyNCIgdmlld0JveD0iMCAwIDI0IDI0IiBmaWxsPSJub25lIiBzdHJva2U9ImN1cnJlbnRDb2xvciIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiIGNsYXNzPSJsdWNpZGUgbHVjaWRlLWNsb2NrIj48Y2lyY2xlIGN4PSIxMiIgY3k9IjEyIiByPSIxMCIvPjxwb2x5bGluZSBwb2ludHM9IjEyIDYgMTIgMTIgMTYgMTQiLz48L3N2Zz4="
-        self.weekday_map = {0: "Monday", 1: "Tuesday", 2: "Wednesday", 3: "Thursday", 4: "Friday", 5: "Saturday", 6: "Sunday"}
+        self._formatters: Dict[Tuple[str, str], _TimeFormatter] = {}
+        self._http_client = None
+        self._http_client_config: Optional[tuple] = None
+        self._history_cache = _HistoryCache()
+        self._history_flights = _SingleFlight()
+        self._history_breaker = _CircuitBreaker()
+        self._last_notifications = _LruCache()
+        self._metrics = _Metrics()
+        self._http_provider = _HttpHistoryProvider(self._get_http_client, lambda: self.valves.streaming_parse, lambda: self.valves.offload_min_bytes, self._offload)
+        self._sqlite_provider: Optional[_SqliteHistoryProvider] = None
+        self._ledger: Optional[_TimestampLedger] = None
+        self._ledger_config: Optional[tuple] = None
+        self._injection_states = _LruCache()
+        self._offload_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
         if not httpx: 
             LOGGER.error("The `httpx` library is not installed. The Time Awareness Filter will not work. Please run `pip install httpx`.")
 
@@ -56,51 +796,338 @@ class Filter:
             LOGGER.error(f"Error extracting JWT token: {e}")
             return None
 
-    async def _get_chat_history(self, chat_id: str, jwt_token: str, event_emitter: Optional[Callable]) -> Optional[Dict]:
+    def _http_client_settings(self) -> tuple:
+        v = self.valves
+        return (v.api_base_url.strip("/"), v.http_max_connections, v.http_max_keepalive_connections, v.http_keepalive_expiry, v.http_connect_timeout, v.http_read_timeout)
+
+    async def _get_http_client(self):
+        """Returns the long-lived pooled client, rebuilding it when the relevant Valves changed."""
+        settings = self._http_client_settings()
+        if self._http_client is not None and not self._http_client.is_closed and settings == self._http_client_config:
+            return self._http_client
+
+        old_client = self._http_client
+        base_url, max_conn, max_keepalive, keepalive_expiry, connect_timeout, read_timeout = settings
+        self._http_client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_keepalive, keepalive_expiry=keepalive_expiry),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._http_client_config = settings
+        if old_client is not None and not old_client.is_closed:
+            if self.valves.debug_print_request: LOGGER.info("HTTP client settings changed, rebuilding the connection pool.")
+            await old_client.aclose()
+        return self._http_client
+
+    async def close(self) -> None:
+        """Closes the pooled HTTP client. Safe to call more than once."""
+        self._history_flights.cancel_all()
+        self._history_cache.clear()
+        self._injection_states.clear()
+        self._last_notifications.clear()
+        if self._ledger is not None:
+            self._ledger.close()
+            self._ledger, self._ledger_config = None, None
+        if self._offload_executor is not None:
+            self._offload_executor.shutdown(wait=False)
+            self._offload_executor = None
+        client, self._http_client, self._http_client_config = self._http_client, None, None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+    def _get_direct_history_providers(self) -> List[_HistoryProvider]:
+        """In-process providers to try, according to `history_provider`, before falling back to HTTP."""
+        if self.valves.history_provider != "sqlite": return []
+        path = self.valves.database_path or _SqliteHistoryProvider.default_path()
+        if self._sqlite_provider is None or self._sqlite_provider.path != path:
+            self._sqlite_provider = _SqliteHistoryProvider(path)
+        return [self._sqlite_provider]
+
+    async def _get_chat_history(self, chat_id: str, jwt_token: Optional[str], etag: Optional[str] = None, user_id: Optional[str] = None, on_first_byte: Optional[Callable[[], None]] = None) -> Optional[Tuple[Optional[Dict], Optional[str]]]:
+        """Fetches the chat document. Returns `(data, etag)`, with `data` set to None when the backend reports it unchanged. Raises on failure."""
+        for provider in self._get_direct_history_providers():
+            try:
+                result = await provider.fetch(chat_id, user_id, jwt_token, etag, on_first_byte)
+                if result is not None: return result
+                if self.valves.debug_print_request: LOGGER.info(f"History provider '{provider.name}' has no data for this chat, falling back to HTTP.")
+            except Exception as e:
+                LOGGER.warning(f"History provider '{provider.name}' failed, falling back to HTTP: {e}")
+
         if not httpx: return None
-        if not jwt_token:
-            LOGGER.error("Authentication token (JWT) is empty, cannot fetch chat history.")
-            if event_emitter: 
-                await event_emitter({"type": "notification", "data": {"type": "error", "content": "Time Awareness: Cannot get user auth info"}})
-            return None
+        if not jwt_token: raise _MissingAuthToken()
+        return await self._http_provider.fetch(chat_id, user_id, jwt_token, etag, on_first_byte)
 
-        api_url = f"{self.valves.api_base_url.strip('/')}/api/v1/chats/{chat_id}"
-        headers = {"Authorization": f"Bearer {jwt_token}"}
-        
+    def _parse_chat_history(self, chat_history_data: Dict, etag: Optional[str], previous: Optional[Dict] = None) -> Dict:
+        """Reduces a chat document to the user-message timestamps the filter needs. `previous` is reused as is when `updated_at` hasn't moved."""
+        updated_at = chat_history_data.get("updated_at")
+        if previous is not None and updated_at is not None and updated_at == previous.get("updated_at"):
+            return {**previous, "etag": etag or previous.get("etag")}
+
+        messages: Dict[str, Tuple[Any, bytes]] = {}
+        parents: Dict[str, Optional[str]] = {}
+        history = chat_history_data.get("chat", {}).get("history", {})
+        history_messages = history.get("messages", {})
+        if isinstance(history_messages, dict):
+            for msg_id, msg_data in history_messages.items():
+                if not isinstance(msg_data, dict): continue
+                parents[msg_id] = msg_data.get("parentId")
+                if msg_data.get("role") != "user" or "timestamp" not in msg_data: continue
+                # Always hashed again: an in-place edit keeps the message's id and timestamp
+                messages[msg_id] = (msg_data.get("timestamp"), _content_digest(msg_data.get("content")))
+
+        return {"messages": messages, "parents": parents, "current_id": history.get("currentId"), "updated_at": updated_at, "etag": etag}
+
+    def _should_offload(self, message_count: int) -> bool:
+        threshold = self.valves.offload_min_messages
+        return threshold > 0 and message_count >= threshold
+
+    async def _offload(self, func: Callable, *args) -> Any:
+        """Runs CPU-heavy work on the filter's single worker thread. One worker keeps offloaded jobs from crowding the event loop out of the GIL."""
+        if self._offload_executor is None:
+            self._offload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="time-awareness")
+        return await asyncio.get_running_loop().run_in_executor(self._offload_executor, func, *args)
+
+    def _active_branch_user_ids(self, history: Dict) -> Optional[List[str]]:
+        """User message ids on the active branch, from the root down to `currentId`. None if the chat has no usable `currentId`."""
+        parents = history.get("parents")
+        node = history.get("current_id")
+        if not parents or node not in parents: return None
+        messages = history["messages"]
+        branch: List[str] = []
+        seen = set()
+        while node is not None and node not in seen:
+            seen.add(node)
+            if node in messages: branch.append(node)
+            node = parents.get(node)
+        branch.reverse()
+        return branch
+
+    def _build_timestamp_index(self, history: Dict, wanted: Counter, branch: Optional[List[str]], resolved: List[Optional[bytes]], skip: int = 0) -> _TimestampIndex:
+        """Timestamps left for the `wanted` digests once the messages resolved on earlier turns (`resolved`, their digests in order, None for the ones that carried a time) have taken theirs.
+
+        Indexes only the active branch (`branch`, from `_active_branch_user_ids`) when it covers every wanted digest, otherwise every user message of
+        the chat sorted by time. The first `skip` user messages of the branch are the first `skip` resolved ones and aren't indexed at all.
+        """
+        messages = history["messages"]
+        claimed = [digest for digest in resolved[skip:] if digest is not None]
+        if branch is not None:
+            counts = Counter(messages[msg_id][1] for msg_id in branch[skip:])
+            if all(counts[digest] >= count for digest, count in (wanted + Counter(claimed)).items()):
+                index = _TimestampIndex()
+                for msg_id in branch[skip:]:
+                    timestamp, digest = messages[msg_id]
+                    index.add(digest, timestamp)
+                for digest in claimed: index.pop(digest)
+                return index
+        index = _TimestampIndex(messages.values())
+        for digest in resolved:
+            if digest is not None: index.pop(digest)
+        return index
+
+    def _user_key(self, user: Optional[dict], jwt_token: Optional[str]) -> str:
+        user_id = user.get("id") if isinstance(user, dict) else None
+        if not user_id and jwt_token: user_id = hashlib.sha256(jwt_token.encode()).hexdigest()
+        return user_id or ""
+
+    def _history_cache_key(self, chat_id: str, user: Optional[dict], jwt_token: Optional[str]) -> Tuple[str, str]:
+        return (self._user_key(user, jwt_token), chat_id)
+
+    async def _load_chat_history(self, chat_id: str, user: Optional[dict], jwt_token: Optional[str], event_emitter: Optional[Callable]) -> Optional[Dict]:
+        """Returns the parsed history, revalidated with the backend on every call. A cached copy saves the download when the backend reports the chat unchanged, and the re-parsing of the messages it already holds."""
+        v = self.valves
+        cache = self._history_cache
+        key = self._history_cache_key(chat_id, user, jwt_token)
+        # A cached copy is never trusted as is: an edit or a branch switch can keep every message text and change only timestamps and `currentId`
+        cached = cache.get(key, v.history_cache_ttl_seconds) if v.history_cache_enabled else None
+        user_id = user.get("id") if isinstance(user, dict) else None
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(api_url, headers=headers)
-                response.raise_for_status()
-                return response.json()
+            # Concurrent inlets for the same chat and user (e.g. multi-model fan-out) share one fetch and parse
+            return await self._history_flights.run(key, lambda: self._refresh_chat_history(key, chat_id, user_id, jwt_token, cached))
+        except _CircuitOpen:
+            raise
+        except _MissingAuthToken:
+            LOGGER.error("Authentication token (JWT) is empty, cannot fetch chat history.")
+            await self._notify_error(event_emitter, key[0], "Time Awareness: Cannot get user auth info")
         except Exception as e:
             LOGGER.error(f"Error fetching or parsing chat history: {e}")
-            if event_emitter: 
-                await event_emitter({"type": "notification", "data": {"type": "error", "content": "Time Awareness: Failed to get history"}})
+            await self._notify_error(event_emitter, key[0], "Time Awareness: Failed to get history")
         return None
 
-    def get_time_prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
-        time_str = dt_object.strftime("%H:%M:%S")
-        if is_full_format:
-            format_str = {"ISO": "%Y-%m-%d", "DMY_SLASH": "%d/%m/%Y", "MDY_SLASH": "%m/%d/%Y", "DMY_DOT": "%d.%m.%Y"}.get(self.valves.date_format, "%Y-%m-%d")
-            date_str = dt_object.strftime(format_str)
-            weekday_str = self.weekday_map[dt_object.weekday()]
-            return f"[{date_str}, {weekday_str}, {time_str}]"
+    async def _notify_error(self, event_emitter: Optional[Callable], user_key: str, content: str) -> None:
+        """Sends an error notification, at most once per `error_notification_interval` for each user."""
+        if not event_emitter: return
+        interval = self.valves.error_notification_interval
+        now = time.monotonic()
+        last = self._last_notifications.get(user_key)
+        if interval > 0 and last is not None and now - last < interval: return
+        self._last_notifications.put(user_key, now, 1024)
+        await event_emitter({"type": "notification", "data": {"type": "error", "content": content}})
+
+    async def _refresh_chat_history(self, key: Tuple[str, str], chat_id: str, user_id: Optional[str], jwt_token: Optional[str], cached: Optional[Dict]) -> Optional[Dict]:
+        v = self.valves
+        cache = self._history_cache
+        breaker = self._history_breaker
+        if not breaker.allow(): raise _CircuitOpen()
+        metrics = self._metrics
+        metrics.counters["history_fetches"] += 1
+        started = time.monotonic()
+        first_byte: List[float] = []
+        try:
+            result = await self._get_chat_history(chat_id, jwt_token, etag=cached.get("etag") if cached else None, user_id=user_id, on_first_byte=lambda: first_byte.append(time.monotonic()))
+        except _MissingAuthToken:
+            raise
+        except BaseException as e:
+            # Cancellation when every waiter ran out of its latency budget counts as a timeout
+            breaker.record(not _is_backend_failure(e), v.circuit_breaker_failures, v.circuit_breaker_cooldown_seconds)
+            metrics.counters["history_fetch_failures"] += 1
+            raise
+        elapsed = time.monotonic() - started
+        # Slowness is judged by the time to the first byte, so a large chat downloading at full speed isn't a failure
+        latency = first_byte[0] - started if first_byte else elapsed
+        breaker.record(latency <= v.circuit_breaker_slow_seconds, v.circuit_breaker_failures, v.circuit_breaker_cooldown_seconds)
+        if v.metrics_enabled: metrics.observe("stage_seconds", "fetch", elapsed)
+        if result is None: return None
+        chat_history_data, etag = result
+        if chat_history_data is None:
+            cache.hits += 1
+            entry = cached
         else:
-            return f"[{time_str}]"
+            cache.misses += 1
+            parse_started = time.perf_counter()
+            history_messages = chat_history_data.get("chat", {}).get("history", {}).get("messages")
+            if self._should_offload(len(history_messages) if isinstance(history_messages, dict) else 0):
+                entry = await self._offload(self._parse_chat_history, chat_history_data, etag, cached)
+            else:
+                entry = self._parse_chat_history(chat_history_data, etag, cached)
+            if v.metrics_enabled:
+                metrics.observe("stage_seconds", "parse", time.perf_counter() - parse_started)
+                metrics.observe("history_user_messages", "", len(entry["messages"]), _Metrics.SIZE_BUCKETS)
+        if v.history_cache_enabled:
+            cache.put(key, entry, v.history_cache_max_chats, v.history_cache_max_messages)
+        return entry
+
+    def _get_ledger(self) -> Optional[_TimestampLedger]:
+        v = self.valves
+        if not v.ledger_enabled: config = None
+        elif v.ledger_backend == "redis": config = ("redis", v.ledger_redis_url, v.ledger_retention_days)
+        else: config = ("sqlite", v.ledger_path or _TimestampLedger.default_path())
+        if config != self._ledger_config:
+            if self._ledger is not None: self._ledger.close()
+            self._ledger, self._ledger_config = None, config
+            if config is None: pass
+            elif config[0] == "sqlite": self._ledger = _TimestampLedger(config[1])
+            elif redis is None: LOGGER.error("The `redis` library is not installed, the ledger is disabled. Please run `pip install redis`.")
+            else: self._ledger = _RedisTimestampLedger(config[1], config[2])
+        return self._ledger
+
+    async def _record_in_ledger(self, ledger: _TimestampLedger, user_key: str, chat_id: str, entries: List[Tuple[bytes, float]]) -> None:
+        try:
+            await asyncio.to_thread(ledger.record, user_key, chat_id, entries)
+            removed = await asyncio.to_thread(ledger.compact, self.valves.ledger_retention_days, self.valves.ledger_max_entries)
+            if removed and self.valves.debug_print_request: LOGGER.info(f"Ledger compaction removed {removed} entries.")
+        except Exception as e:
+            LOGGER.warning(f"Failed to write to the timestamp ledger: {e}")
+
+    def history_cache_stats(self) -> Dict[str, int]:
+        return {**self._history_cache.stats(), "coalesced": self._history_flights.coalesced, "circuit_rejected": self._history_breaker.rejected}
 
-    def _get_text_from_content(self, content: Union[str, list, None]) -> str:
-        if isinstance(content, str): return content
-        if isinstance(content, list):
-            return "\n".join([p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text"])
-        return ""
+    def metrics_snapshot(self) -> Dict:
+        """Current metrics as a dict. Stage timings and histograms are only filled while `metrics_enabled` is on."""
+        cache = self._history_cache.stats()
+        bytes_read = self._http_provider.bytes_read + (self._sqlite_provider.bytes_read if self._sqlite_provider else 0)
+        counters = {
+            "history_cache_hits": cache["hits"], "history_cache_misses": cache["misses"], "history_cache_evictions": cache["evictions"],
+            "history_coalesced": self._history_flights.coalesced, "history_circuit_rejected": self._history_breaker.rejected, "history_bytes_read": bytes_read,
+        }
+        return self._metrics.snapshot(counters, {"history_cache_chats": cache["chats"], "history_cache_messages": cache["messages"]})
+
+    def metrics_prometheus(self) -> str:
+        return _Metrics.to_prometheus(self.metrics_snapshot())
+
+    def _log_metrics(self) -> None:
+        interval = self.valves.metrics_log_interval
+        now = time.monotonic()
+        if interval <= 0 or now - self._metrics.last_logged < interval: return
+        self._metrics.last_logged = now
+        if self.valves.metrics_log_format == "prometheus":
+            LOGGER.info(f"Metrics:\n{self.metrics_prometheus()}")
+        else:
+            LOGGER.info(f"Metrics: {json.dumps(self.metrics_snapshot(), separators=(',', ':'))}")
+
+    def _get_formatter(self, timezone_name: str) -> _TimeFormatter:
+        """Returns the cached formatter for (timezone, date_format), falling back to UTC for an invalid timezone."""
+        key = (timezone_name, self.valves.date_format)
+        formatter = self._formatters.get(key)
+        if formatter is None:
+            try:
+                tz = zoneinfo.ZoneInfo(timezone_name)
+            except Exception as e:
+                LOGGER.error(f"Invalid timezone '{timezone_name}', falling back to UTC. Error: {e}")
+                tz = zoneinfo.ZoneInfo("UTC")
+            if len(self._formatters) >= 64: self._formatters.clear()
+            formatter = self._formatters[key] = _TimeFormatter(tz, self.valves.date_format, _LOCALE)
+        return formatter
+
+    def get_time_prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
+        return self._get_formatter(getattr(dt_object.tzinfo, "key", "UTC")).prefix(dt_object, is_full_format)
 
-    async def inlet(self, body: dict, __metadata__: Optional[dict] = None, __event_emitter__: Optional[Callable] = None, __request__: Optional[object] = None) -> dict:
+    def _render_prefixes(self, formatter: _TimeFormatter, stamped: List[Tuple[int, datetime.datetime]]) -> List[Tuple[int, str]]:
+        mode = self.valves.prefix_compaction
+        prefixes: List[Tuple[int, str]] = []
+        previous: Optional[datetime.datetime] = None
+        for i, dt in stamped:
+            if previous is None or dt.date() != previous.date():
+                prefixes.append((i, formatter.prefix(dt, True)))
+            elif mode == "minute_runs":
+                if (dt.hour, dt.minute) != (previous.hour, previous.minute): prefixes.append((i, formatter.prefix(dt, False)))
+            elif mode == "relative" and dt >= previous:
+                prefixes.append((i, _format_offset((dt - previous).total_seconds())))
+            else:
+                prefixes.append((i, formatter.prefix(dt, False)))
+            previous = dt
+        return prefixes
+
+    def _compact_prefixes(self, formatter: _TimeFormatter, stamped: List[Tuple[int, datetime.datetime]], current_index: int) -> List[Tuple[int, str]]:
+        """Prefixes for `prefix_compaction` and `prefix_token_budget`. `stamped` lists (message index, time) in order; the current message always gets the full prefix."""
+        v = self.valves
+        past = [(i, dt) for i, dt in stamped if i != current_index]
+        if v.prefix_compaction == "last_n": past = past[-v.prefix_compaction_last_n:] if v.prefix_compaction_last_n > 0 else []
+        prefixes = self._render_prefixes(formatter, past)
+        budget = v.prefix_token_budget
+        if budget > 0:
+            # Keep the newest prefixes that fit, then re-render so the oldest kept message becomes the day anchor
+            costs = {i: _estimate_tokens(prefix) for i, prefix in prefixes}
+            start = len(past)
+            spent = 0
+            while start > 0 and spent + costs.get(past[start - 1][0], 0) <= budget:
+                start -= 1
+                spent += costs.get(past[start][0], 0)
+            while True:
+                kept = self._render_prefixes(formatter, past[start:])
+                if start >= len(past) or sum(_estimate_tokens(prefix) for _, prefix in kept) <= budget: break
+                start += 1
+            prefixes = kept
+        current = [(i, formatter.prefix(dt, True)) for i, dt in stamped if i == current_index]
+        return prefixes + current
+
+    def _apply_time_prefix(self, message: dict, time_prefix: str) -> None:
+        content = message.get("content")
+        if isinstance(content, str): message["content"] = f"{time_prefix}\n{content}"
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    part["text"] = f"{time_prefix}\n{part.get('text', '')}"; return
+            content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
+
+    async def inlet(self, body: dict, __metadata__: Optional[dict] = None, __event_emitter__: Optional[Callable] = None, __request__: Optional[object] = None, __user__: Optional[dict] = None) -> dict:
         start_time = time.time()
         
         if not self.toggle or not __request__:
             if not __request__: LOGGER.warning("Could not access __request__, skipping time injection.")
             return body
 
+        metrics = self._metrics if self.valves.metrics_enabled else None
+        stage_started = started = time.perf_counter() if metrics else 0.0
         if self.valves.debug_print_request: LOGGER.info("--- Time Awareness Filter starting ---")
 
         messages_to_send = body.get("messages", [])
@@ -115,21 +1142,17 @@ class Filter:
             else:
                 LOGGER.warning("Could not find timezone in metadata, falling back to UTC.")
 
-        try:
-            tz = zoneinfo.ZoneInfo(user_timezone_str)
-        except Exception as e:
-            LOGGER.error(f"Invalid timezone '{user_timezone_str}', falling back to UTC. Error: {e}")
-            tz = zoneinfo.ZoneInfo("UTC")
+        formatter = self._get_formatter(user_timezone_str)
 
         # If it's a new chat, just add a timestamp to the current message
         chat_id = __metadata__.get("chat_id") if __metadata__ else None
         if not chat_id:
             if messages_to_send[-1].get("role") == "user":
-                time_prefix = self.get_time_prefix(datetime.datetime.now(tz), is_full_format=True)
+                time_prefix = formatter.prefix(datetime.datetime.now(formatter.tz), is_full_format=True)
                 last_message = messages_to_send[-1]
                 content = last_message.get("content")
                 
-                if self._get_text_from_content(content).strip().startswith("["): return body
+                if _content_starts_with_bracket(content): return body
                 
                 if isinstance(content, str):
                     last_message["content"] = f"{time_prefix}\n{content}"
@@ -137,60 +1160,166 @@ class Filter:
                     content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
             return body
 
-        # For existing chats, fetch history and inject time
-        jwt_token = self._extract_jwt_from_request(__request__)
-        chat_history_data = await self._get_chat_history(chat_id, jwt_token, __event_emitter__)
-        if not chat_history_data:
-            LOGGER.warning("Failed to get chat history, skipping time injection.")
-            return body
-
-        content_to_timestamps_map = defaultdict(list)
-        history_messages = chat_history_data.get("chat", {}).get("history", {}).get("messages", {})
-        
-        if isinstance(history_messages, dict):
-            sorted_history = sorted(history_messages.values(), key=lambda msg: msg.get("timestamp", 0))
-            for msg_data in sorted_history:
-                if isinstance(msg_data, dict) and msg_data.get("role") == "user":
-                    text_content = self._get_text_from_content(msg_data.get("content"))
-                    if "timestamp" in msg_data:
-                        content_to_timestamps_map[text_content].append(msg_data.get("timestamp"))
-
         last_user_message_idx = -1
         for i in range(len(messages_to_send) - 1, -1, -1):
             if messages_to_send[i].get("role") == "user":
                 last_user_message_idx = i; break
 
-        last_processed_date: Optional[datetime.date] = None
-        for i, message in enumerate(messages_to_send):
-            if message.get("role") == "user":
-                content = message.get("content")
-                text_content = self._get_text_from_content(content)
-                if text_content.strip().startswith('['): continue
+        # Digests of the user messages; messages that already start with "[" are left alone
+        if self._should_offload(len(messages_to_send)):
+            digests, bracketed, fingerprints = await self._offload(_digest_user_messages, messages_to_send)
+        else:
+            digests, bracketed, fingerprints = _digest_user_messages(messages_to_send)
+        if metrics:
+            metrics.observe("chat_messages", "", len(messages_to_send), _Metrics.SIZE_BUCKETS)
+            stage_started = metrics.lap("prepare", stage_started)
+        jwt_token = self._extract_jwt_from_request(__request__)
+        user_key = self._user_key(__user__, jwt_token)
+        if metrics: stage_started = metrics.lap("token", stage_started)
+
+        # Reuse what earlier turns resolved for the unchanged start of the conversation. A message is reused only while the
+        # fingerprint of the user message after it is unchanged, which covers its text, the replies and everything before it
+        user_indices = list(digests)
+        state_key = (user_key, chat_id)
+        state = self._injection_states.get(state_key) if self.valves.incremental_injection else None
+        resumed = 0
+        if state is not None and state["timezone"] == user_timezone_str and state["date_format"] == self.valves.date_format:
+            state_chains = state["chains"]
+            limit = min(len(state_chains), len(user_indices) - 1)
+            while resumed < limit and state_chains[resumed] == fingerprints[user_indices[resumed + 1]]:
+                resumed += 1
+        pending = user_indices[resumed:]
+
+        # Timestamps this filter stamped on earlier turns, keyed by branch fingerprint (None when ambiguous)
+        ledger = self._get_ledger()
+        ledger_timestamps: Dict[bytes, Optional[float]] = {}
+        if ledger:
+            try:
+                ledger_timestamps = await asyncio.to_thread(ledger.lookup, user_key, chat_id)
+            except Exception as e:
+                LOGGER.warning(f"Failed to read the timestamp ledger: {e}")
+                ledger = None
 
-                current_dt = None
-                if i == last_user_message_idx:
-                    current_dt = datetime.datetime.now(tz)
+        needed = [i for i in pending if i != last_user_message_idx and i not in bracketed]
+        wanted = Counter(digests[i] for i in needed if ledger_timestamps.get(fingerprints[i]) is None)
+        # Texts can repeat on two branches, so reused messages are checked against the message ids of the history. That's not
+        # needed when the request carries the ids (they are part of the fingerprints) or the ledger knows every reused message;
+        # otherwise a turn that needs nothing else from the history still fetches it
+        verify = resumed > 0 and not all(messages_to_send[i].get("id") for i in user_indices[:resumed]) and not (ledger and all(ledger_timestamps.get(fingerprints[i]) is not None for i in user_indices[:resumed] if i not in bracketed))
+        if metrics: stage_started = metrics.lap("resume", stage_started)
+
+        # For existing chats, fetch history (or reuse the cached copy) for whatever the ledger can't resolve, and inject time
+        timestamp_index = _TimestampIndex()
+        history_messages: Dict[str, Tuple[Any, bytes]] = {}
+        aligned: Optional[List[str]] = None
+        if wanted or verify:
+            budget = self.valves.history_latency_budget
+            try:
+                history = await asyncio.wait_for(self._load_chat_history(chat_id, __user__, jwt_token, __event_emitter__), timeout=budget if budget > 0 else None)
+            except asyncio.TimeoutError:
+                LOGGER.warning(f"Chat history not available within {budget}s, stamping only messages that need no history.")
+                history = {"messages": {}}
+            except _CircuitOpen:
+                if self.valves.debug_print_request: LOGGER.info("History fetches are paused after repeated failures, stamping only messages that need no history.")
+                history = {"messages": {}}
+            if not history:
+                # A failed fetch degrades like a timeout rather than leaving the current message unstamped
+                LOGGER.warning("Failed to get chat history, stamping only messages that need no history.")
+                history = {"messages": {}}
+            if metrics: stage_started = metrics.lap("history", stage_started)
+            if self.valves.debug_print_request: LOGGER.info(f"History cache: {self._history_cache.stats()}")
+            history_messages = history["messages"]
+            branch = self._active_branch_user_ids(history) if history_messages else None
+            # The branch's user message ids line up with the user messages of the request unless messages were added or removed
+            if branch is not None and len(branch) >= len(user_indices) - 1: aligned = branch
+            if verify and history_messages:
+                state_ids = state["ids"]
+                verified = 0
+                while aligned is not None and verified < resumed and state_ids[verified] == aligned[verified]:
+                    verified += 1
+                if verified < resumed:
+                    resumed = verified
+                    pending = user_indices[resumed:]
+                    needed = [i for i in pending if i != last_user_message_idx and i not in bracketed]
+            if history_messages and needed:
+                # Resolved messages still at their place in the branch keep their timestamps out of the index without indexing them
+                skip = 0
+                while aligned is not None and skip < resumed and history_messages[aligned[skip]][1] == digests[user_indices[skip]]:
+                    skip += 1
+                resolved = [None if i in bracketed else digests[i] for i in user_indices[:resumed]]
+                index_args = (history, Counter(digests[i] for i in needed), branch, resolved, skip)
+                if self._should_offload(len(history.get("parents") or history_messages)):
+                    timestamp_index = await self._offload(self._build_timestamp_index, *index_args)
                 else:
-                    timestamp_queue = content_to_timestamps_map.get(text_content)
-                    if timestamp_queue:
-                        timestamp = timestamp_queue.pop(0)
-                        current_dt = datetime.datetime.fromtimestamp(timestamp, tz)
-                    else: continue
-                
-                if not current_dt: continue
+                    timestamp_index = self._build_timestamp_index(*index_args)
+            if metrics: stage_started = metrics.lap("index", stage_started)
 
-                use_full_format = (last_processed_date is None) or (current_dt.date() != last_processed_date)
-                time_prefix = self.get_time_prefix(current_dt, use_full_format)
+        new_ledger_entries: List[Tuple[bytes, float]] = []
+        resolved_chains: List[bytes] = state["chains"][:resumed] if resumed else []
+        resolved_ids: List[Optional[str]] = state["ids"][:resumed] if resumed else []
+        resolved_prefixes: List[Optional[str]] = state["prefixes"][:resumed] if resumed else []
+        resolved_dates: List[Optional[datetime.date]] = state["dates"][:resumed] if resumed else []
+        resolved_times: List[Optional[datetime.datetime]] = state["times"][:resumed] if resumed else []
+        compacting = self.valves.prefix_compaction != "off" or self.valves.prefix_token_budget > 0
+        stamped: List[Tuple[int, datetime.datetime]] = [(i, dt) for i, dt in zip(user_indices, resolved_times) if dt is not None]
+        if not compacting:
+            for i, time_prefix in zip(user_indices, resolved_prefixes):
+                if time_prefix is not None: self._apply_time_prefix(messages_to_send[i], time_prefix)
 
-                if isinstance(content, str): message["content"] = f"{time_prefix}\n{content}"
-                elif isinstance(content, list):
-                    text_part_found = False
-                    for part in content:
-                        if part.get("type") == "text":
-                            part["text"] = f"{time_prefix}\n{part.get('text', '')}"; text_part_found = True; break
-                    if not text_part_found: content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
+        # A message without a timestamp is retried on the next turn, so nothing after it is remembered
+        # Resolve the pending timestamps first, then localize them in one pass
+        pending_timestamps: List[Optional[float]] = []
+        for i in pending:
+            timestamp = None
+            if i in bracketed: pass
+            elif i == last_user_message_idx:
+                timestamp = time.time()
+            else:
+                timestamp = timestamp_index.pop(digests[i])
+                known_message = history_messages.get(messages_to_send[i].get("id"))
+                if known_message is not None: timestamp = known_message[0]
+                # The history, when it was fetched, wins; the ledger fills in what it couldn't resolve
+                if timestamp is None: timestamp = ledger_timestamps.get(fingerprints[i])
+            pending_timestamps.append(timestamp)
+
+        unresolved = False
+        last_processed_date: Optional[datetime.date] = resolved_dates[-1] if resolved_dates else None
+        for i, timestamp, current_dt in zip(pending, pending_timestamps, formatter.localize(pending_timestamps)):
+            time_prefix = None
+            if i not in bracketed:
+                if current_dt is not None:
+                    if ledger and _TimestampLedger.should_record(ledger_timestamps, fingerprints[i], timestamp): new_ledger_entries.append((fingerprints[i], timestamp))
+                    current_date = current_dt.date()
+                    time_prefix = formatter.prefix(current_dt, current_date != last_processed_date)
+                    if compacting: stamped.append((i, current_dt))
+                    else: self._apply_time_prefix(messages_to_send[i], time_prefix)
+                    last_processed_date = current_date
+                else:
+                    unresolved = True
+
+            if i != last_user_message_idx and not unresolved:
+                position = len(resolved_chains)
+                resolved_chains.append(fingerprints[user_indices[position + 1]])
+                resolved_ids.append(aligned[position] if aligned is not None and history_messages[aligned[position]][1] == digests[i] else None)
+                resolved_prefixes.append(time_prefix)
+                resolved_dates.append(last_processed_date)
+                resolved_times.append(current_dt if time_prefix is not None else None)
+        if compacting:
+            for i, time_prefix in self._compact_prefixes(formatter, stamped, last_user_message_idx):
+                self._apply_time_prefix(messages_to_send[i], time_prefix)
+        if metrics: stage_started = metrics.lap("inject", stage_started)
+
+        if self.valves.incremental_injection:
+            self._injection_states.put(state_key, {"timezone": user_timezone_str, "date_format": self.valves.date_format, "chains": resolved_chains, "ids": resolved_ids, "prefixes": resolved_prefixes, "dates": resolved_dates, "times": resolved_times}, self.valves.history_cache_max_chats)
+            if self.valves.debug_print_request: LOGGER.info(f"Incremental injection reused {resumed} of {len(user_indices)} user messages.")
+
+        if ledger and new_ledger_entries:
+            await self._record_in_ledger(ledger, user_key, chat_id, new_ledger_entries)
 
-                last_processed_date = current_dt.date()
+        if metrics:
+            metrics.lap("save", stage_started)
+            metrics.observe("stage_seconds", "total", time.perf_counter() - started)
+            self._log_metrics()
 
         if self.valves.debug_print_request:
             LOGGER.info(f"Final messages sent to model:\n{json.dumps(messages_to_send, indent=2, ensure_ascii=False)}")
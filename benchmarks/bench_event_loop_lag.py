@@ -0,0 +1,90 @@
+"""Measures event-loop lag while concurrent inlets process large chats, with and without offloading to worker threads.
+
+A probe task sleeps for `--tick` seconds in a loop and records how late it wakes up; that lateness is the delay every
+other request sharing the worker would see. Each mode runs the same inlets with the history cache disabled, so every
+inlet decodes, parses and indexes its chat.
+
+Usage: python benchmarks/bench_event_loop_lag.py [--chats 8] [--turns 3000] [--rounds 3] [--streaming]
+"""
+import argparse
+import asyncio
+import copy
+import statistics
+import time
+
+from common import DEFAULT_FILTER, load_filter_module, synthetic_chat
+from stub_backend import StubBackend
+
+
+class _Request:
+    headers = {"authorization": "Bearer bench.jwt.token"}
+
+
+async def _probe(tick: float, lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append(time.perf_counter() - started - tick)
+
+
+async def _run_mode(module, backend: StubBackend, bodies: dict, args, offload: bool) -> None:
+    plugin = module.Filter()
+    plugin.valves.api_base_url = backend.base_url
+    plugin.valves.streaming_parse = args.streaming
+    plugin.valves.history_cache_enabled = False
+    plugin.valves.incremental_injection = False
+    plugin.valves.history_latency_budget = 0
+    plugin.valves.circuit_breaker_failures = 0
+    plugin.valves.offload_min_messages = args.offload_min_messages if offload else 0
+    plugin.valves.offload_min_bytes = args.offload_min_bytes if offload else 0
+
+    batches = [[copy.deepcopy({"messages": body}) for body in bodies.values()] for _ in range(args.rounds)]
+    lags: list = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_probe(args.tick, lags, stop))
+    started = time.perf_counter()
+    for batch in batches:
+        await asyncio.gather(*(
+            plugin.inlet(body, __metadata__={"chat_id": chat_id}, __request__=_Request(), __user__={"id": "bench-user"})
+            for chat_id, body in zip(bodies, batch)
+        ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    await plugin.close()
+
+    lags.sort()
+    p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+    label = "offload" if offload else "inline"
+    print(f"{label:<8} wall {elapsed * 1000:8.1f} ms   loop lag p50 {statistics.median(lags) * 1000:7.2f} ms   p99 {p99 * 1000:7.2f} ms   max {lags[-1] * 1000:7.2f} ms")
+
+
+async def run(args) -> None:
+    module = load_filter_module(args.filter)
+    backend = await StubBackend().start()
+    bodies = {}
+    for n in range(args.chats):
+        document, body = synthetic_chat(f"chat-{n}", args.turns, seed=n)
+        backend.add_chat(document)
+        bodies[document["id"]] = body
+    print(f"{args.chats} chats x {args.turns * 2} messages, {args.rounds} rounds, streaming_parse={args.streaming}")
+    await _run_mode(module, backend, bodies, args, offload=False)
+    await _run_mode(module, backend, bodies, args, offload=True)
+    await backend.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=8, help="concurrent inlets per round, one per chat")
+    parser.add_argument("--turns", type=int, default=3000, help="user/assistant pairs per chat")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--tick", type=float, default=0.001, help="probe sleep interval in seconds")
+    parser.add_argument("--offload-min-messages", type=int, default=2000)
+    parser.add_argument("--offload-min-bytes", type=int, default=1000000)
+    parser.add_argument("--streaming", action="store_true", help="use the streaming parser instead of full JSON decoding")
+    parser.add_argument("--filter", default=DEFAULT_FILTER, help="path of the filter file to benchmark")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Counts backend fetches when several inlets for the same chat run concurrently (multi-model fan-out).
+
+Usage: python benchmarks/bench_fanout.py [--models 4] [--chats 20] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import copy
+import time
+
+from common import DEFAULT_FILTER, load_filter_module, synthetic_chat
+from stub_backend import StubBackend
+
+
+class _Request:
+    headers = {"authorization": "Bearer bench.jwt.token"}
+
+
+async def run(args) -> None:
+    module = load_filter_module(args.filter)
+    backend = await StubBackend(latency=args.latency).start()
+    bodies = {}
+    for n in range(args.chats):
+        document, body = synthetic_chat(f"chat-{n}", args.turns, seed=n)
+        backend.add_chat(document)
+        bodies[document["id"]] = body
+
+    plugin = module.Filter()
+    plugin.valves.api_base_url = backend.base_url
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        plugin.inlet(copy.deepcopy({"messages": body}), __metadata__={"chat_id": chat_id}, __request__=_Request(), __user__={"id": "bench-user"})
+        for chat_id, body in bodies.items()
+        for _ in range(args.models)
+    ))
+    elapsed = time.perf_counter() - started
+    print(f"inlets {args.chats * args.models}   backend fetches {backend.total_fetches}   wall {elapsed * 1000:.1f} ms")
+    print(f"history cache: {plugin.history_cache_stats()}")
+    await plugin.close()
+    await backend.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", type=int, default=4, help="concurrent inlets per chat")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="backend latency in seconds")
+    parser.add_argument("--filter", default=DEFAULT_FILTER, help="path of the filter file to benchmark")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Compares peak memory and time of the full-JSON and streaming chat history parse paths.
+
+Usage: python benchmarks/bench_history_parse.py [--size-mb 50] [--filter "Time Awareness.py"]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from common import DEFAULT_FILTER, load_filter_module, synthetic_chat
+
+
+async def _chunks(raw: bytes, chunk_size: int):
+    view = memoryview(raw)
+    for offset in range(0, len(raw), chunk_size):
+        yield bytes(view[offset:offset + chunk_size])
+
+
+def _measure(label: str, run) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} peak {peak / 2**20:8.1f} MiB   time {elapsed * 1000:8.1f} ms   user messages {len(result['messages'])}")
+    return {"peak_bytes": peak, "seconds": elapsed, "user_messages": len(result["messages"])}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=50.0, help="approximate size of the synthetic chat document")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--chunk-kb", type=int, default=64, help="size of the chunks fed to the streaming parser")
+    parser.add_argument("--filter", default=DEFAULT_FILTER, help="path of the filter file to benchmark")
+    args = parser.parse_args()
+
+    module = load_filter_module(args.filter)
+    image_bytes = int(args.size_mb * 2**20 * 3 / 4 / 2 / args.turns)  # base64 grows by 4/3; each image is stored twice
+    document, _ = synthetic_chat("bench", args.turns, image_bytes=image_bytes)
+    raw = json.dumps(document).encode()
+    del document
+    print(f"chat document: {len(raw) / 2**20:.1f} MiB, {args.turns} turns")
+
+    plugin = module.Filter()
+    _measure("json", lambda: plugin._parse_chat_history(json.loads(raw), None))
+    if module.ijson is None:
+        print("streaming: skipped, `ijson` is not installed")
+        return
+    _measure("streaming", lambda: plugin._parse_chat_history(asyncio.run(module._stream_chat_document(_chunks(raw, args.chunk_kb * 1024))), None))
+
+
+if __name__ == "__main__":
+    main()
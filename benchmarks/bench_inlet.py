@@ -0,0 +1,230 @@
+"""Drives `Filter.inlet` against the stub backend and reports latency percentiles, throughput, peak memory and bytes fetched.
+
+Every chat is replayed turn by turn (its last `--replay-turns` turns, one inlet each), with up to `--concurrency` chats
+in flight at once, the way many users chatting at the same time hit one Open WebUI worker. Results can be saved as
+JSON and compared with an earlier run, for example of another version of the filter:
+
+    python benchmarks/bench_inlet.py --filter old/"Time Awareness.py" --output before.json
+    python benchmarks/bench_inlet.py --compare before.json
+
+Peak memory is measured with tracemalloc in a second, untimed pass, so tracing doesn't distort the latencies.
+
+Usage: python benchmarks/bench_inlet.py [--chats 50] [--turns 100] [--concurrency 10] [--latency 0.02] [--output results.json]
+"""
+import argparse
+import asyncio
+import copy
+import inspect
+import json
+import math
+import platform
+import re
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from common import DEFAULT_FILTER, load_filter_module, synthetic_chat
+from stub_backend import StubBackend
+
+TIMEZONES = ("UTC", "Asia/Shanghai", "Europe/Berlin", "America/New_York", "Asia/Kolkata", "Australia/Sydney", "America/Los_Angeles", "America/Sao_Paulo")
+
+# Lower is better for every compared metric except throughput
+COMPARED = (("latency_ms.p50", False), ("latency_ms.p95", False), ("latency_ms.p99", False), ("throughput_rps", True), ("peak_memory_bytes", False), ("bytes_fetched", False), ("backend_fetches", False))
+
+
+class _Request:
+    headers = {"authorization": "Bearer bench.jwt.token"}
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))]
+
+
+def _parse_valve(plugin, assignment: str) -> None:
+    name, _, raw = assignment.partition("=")
+    fields = type(plugin.valves).model_fields
+    if name not in fields: raise SystemExit(f"unknown valve: {name}")
+    annotation = fields[name].annotation
+    if annotation is bool: value = raw.strip().lower() in ("1", "true", "yes", "on")
+    else: value = annotation(raw)
+    setattr(plugin.valves, name, value)
+
+
+def _build_workload(args) -> (List[Dict], Dict[str, List[Dict]]):
+    """Chat documents for the stub, and for every chat the request bodies of the turns to replay, in order."""
+    documents = []
+    requests: Dict[str, List[Dict]] = {}
+    for n in range(args.chats):
+        document, body = synthetic_chat(
+            f"chat-{n}", args.turns, image_bytes=args.image_bytes, answer_chars=args.answer_chars, seed=args.seed + n,
+            dup_ratio=args.dup_ratio, multimodal_ratio=args.multimodal_ratio, branch_ratio=args.branch_ratio,
+        )
+        documents.append(document)
+        timezone = TIMEZONES[n % max(1, min(args.timezones, len(TIMEZONES)))]
+        metadata = {"chat_id": document["id"], "variables": {"{{CURRENT_TIMEZONE}}": timezone}}
+        first = max(0, args.turns - args.replay_turns)
+        requests[document["id"]] = [{"body": {"messages": body[:2 * turn + 1]}, "metadata": metadata, "user": {"id": f"bench-user-{n % args.users}"}} for turn in range(first, args.turns)]
+    return documents, requests
+
+
+async def _replay(module, backend: StubBackend, requests: Dict[str, List[Dict]], args, latencies: Optional[List[float]]) -> int:
+    """Replays every chat, at most `concurrency` at a time. Returns the number of failed inlets."""
+    plugin = module.Filter()
+    plugin.valves.api_base_url = backend.base_url
+    for assignment in args.valve: _parse_valve(plugin, assignment)
+    # Like Open WebUI, only pass the dunder arguments this version of `inlet` declares
+    accepted = inspect.signature(plugin.inlet).parameters
+    semaphore = asyncio.Semaphore(args.concurrency)
+    errors = 0
+
+    async def chat(turns: List[Dict]) -> None:
+        nonlocal errors
+        async with semaphore:
+            for turn in turns:
+                body = copy.deepcopy(turn["body"])
+                extras = {"__metadata__": turn["metadata"], "__request__": _Request(), "__user__": turn["user"]}
+                extras = {key: value for key, value in extras.items() if key in accepted}
+                started = time.perf_counter()
+                try:
+                    await plugin.inlet(body, **extras)
+                except Exception as exc:
+                    if not errors: print(f"inlet failed: {exc!r}")
+                    errors += 1
+                if latencies is not None: latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(chat(turns) for turns in requests.values()))
+    # Older filters (e.g. the baseline in --compare runs) have no close()
+    close = getattr(plugin, "close", None)
+    if close is not None: await close()
+    return errors
+
+
+def _filter_version(path: str) -> Optional[str]:
+    with open(path, encoding="utf-8") as file:
+        match = re.search(r"^version:\s*(\S+)", file.read(2048), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def _lookup(results: Dict, dotted: str):
+    for key in dotted.split("."):
+        results = results.get(key) if isinstance(results, dict) else None
+    return results
+
+
+def _compare(current: Dict, baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    print(f"\ncompared with {baseline_path} ({baseline.get('filter')}, version {baseline.get('filter_version')})")
+    for metric, higher_is_better in COMPARED:
+        before, after = _lookup(baseline["results"], metric), _lookup(current["results"], metric)
+        if not before or after is None:
+            continue
+        change = after / before - 1
+        worse = change < 0 if higher_is_better else change > 0
+        flag = "  <-- regression" if worse and abs(change) >= 0.1 else ""
+        print(f"{metric:<20} {before:>14.2f} -> {after:>14.2f}   {change:+7.1%}{flag}")
+
+
+async def run(args) -> None:
+    module = load_filter_module(args.filter)
+    documents, requests = _build_workload(args)
+    backend = await StubBackend(latency=args.latency, padding=args.padding).start()
+    for document in documents: backend.add_chat(document)
+    total = sum(len(turns) for turns in requests.values())
+
+    for _ in range(args.warmup):
+        await _replay(module, backend, {chat_id: turns[:1] for chat_id, turns in requests.items()}, args, None)
+    backend.fetches.clear()
+    backend.bytes_sent = 0
+
+    latencies: List[float] = []
+    started = time.perf_counter()
+    errors = await _replay(module, backend, requests, args, latencies)
+    wall = time.perf_counter() - started
+    fetches, bytes_fetched = backend.total_fetches, backend.bytes_sent
+
+    peak = None
+    if not args.no_trace_memory:
+        tracemalloc.start()
+        await _replay(module, backend, requests, args, None)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    await backend.close()
+
+    latencies.sort()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    results = {
+        "filter": args.filter,
+        "filter_version": _filter_version(args.filter),
+        "python": platform.python_version(),
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": {
+            "requests": total,
+            "errors": errors,
+            "wall_seconds": round(wall, 4),
+            "throughput_rps": round(total / wall, 2),
+            "latency_ms": {
+                "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+                "p95": round(_percentile(latencies, 0.95) * 1000, 3),
+                "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+                "mean": round(statistics.fmean(latencies) * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3),
+            },
+            "peak_memory_bytes": peak,
+            "max_rss_bytes": max_rss,
+            "backend_fetches": fetches,
+            "bytes_fetched": bytes_fetched,
+        },
+    }
+
+    summary = results["results"]
+    latency = summary["latency_ms"]
+    print(f"{total} inlets over {args.chats} chats, concurrency {args.concurrency}, backend latency {args.latency * 1000:.0f} ms")
+    print(f"latency   p50 {latency['p50']:.2f} ms   p95 {latency['p95']:.2f} ms   p99 {latency['p99']:.2f} ms   max {latency['max']:.2f} ms")
+    print(f"throughput {summary['throughput_rps']:.1f} inlets/s   errors {errors}")
+    peak_text = f"{peak / 2**20:.1f} MiB" if peak is not None else "not traced"
+    print(f"memory    peak {peak_text}   max RSS {max_rss / 2**20:.1f} MiB")
+    print(f"backend   {fetches} fetches, {bytes_fetched / 2**20:.2f} MiB fetched")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"results saved to {args.output}")
+    if args.compare: _compare(results, args.compare)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--chats", type=int, default=50)
+    workload.add_argument("--turns", type=int, default=100, help="user/assistant pairs per chat")
+    workload.add_argument("--replay-turns", type=int, default=5, help="last turns of each chat sent as inlets, in order")
+    workload.add_argument("--users", type=int, default=10, help="chats are spread over this many users")
+    workload.add_argument("--dup-ratio", type=float, default=0.1, help="share of user messages repeating an earlier text")
+    workload.add_argument("--multimodal-ratio", type=float, default=0.1, help="share of user messages sent as list content with an image")
+    workload.add_argument("--image-bytes", type=int, default=0, help="size of each image; 0 uses a tiny placeholder")
+    workload.add_argument("--branch-ratio", type=float, default=0.05, help="share of turns with an abandoned edit branch")
+    workload.add_argument("--answer-chars", type=int, default=200)
+    workload.add_argument("--timezones", type=int, default=4, help=f"chats are spread over this many time zones (max {len(TIMEZONES)})")
+    workload.add_argument("--seed", type=int, default=0)
+    backend = parser.add_argument_group("backend")
+    backend.add_argument("--latency", type=float, default=0.02, help="stub backend latency in seconds")
+    backend.add_argument("--padding", type=int, default=0, help="extra bytes added to every served chat document")
+    driver = parser.add_argument_group("driver")
+    driver.add_argument("--concurrency", type=int, default=10, help="chats replayed at the same time")
+    driver.add_argument("--warmup", type=int, default=0, help="untimed passes over the first replayed turn before measuring")
+    driver.add_argument("--valve", action="append", default=[], metavar="NAME=VALUE", help="set a filter valve, e.g. --valve streaming_parse=false")
+    driver.add_argument("--no-trace-memory", action="store_true", help="skip the tracemalloc pass")
+    driver.add_argument("--filter", default=DEFAULT_FILTER, help="path of the filter file to benchmark")
+    driver.add_argument("--output", help="save the results as JSON to this path")
+    driver.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
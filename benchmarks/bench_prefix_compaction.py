@@ -0,0 +1,92 @@
+"""Reports how many prefix characters and estimated tokens each `prefix_compaction` mode saves on synthetic chats.
+
+Every mode runs the same chats through `inlet` and measures the characters the filter added to the request. Savings
+are relative to the uncompacted output ("off" without a budget, the `get_time_prefix` format). Tokens are estimated at
+about 4 characters each.
+
+Usage: python benchmarks/bench_prefix_compaction.py [--chats 10] [--turns 500] [--budget 0] [--last-n 20] [--sample]
+"""
+import argparse
+import asyncio
+import copy
+import random
+
+from common import DEFAULT_FILTER, load_filter_module, synthetic_chat
+from stub_backend import StubBackend
+
+MODES = ("off", "last_n", "minute_runs", "relative")
+
+
+class _Request:
+    headers = {"authorization": "Bearer bench.jwt.token"}
+
+
+def _text_length(message: dict) -> int:
+    content = message.get("content")
+    if isinstance(content, str): return len(content)
+    return sum(len(part.get("text", "")) for part in content if part.get("type") == "text")
+
+
+def _bursty_chat(chat_id: str, turns: int, seed: int):
+    """A synthetic chat whose user messages often come in quick bursts, as in real conversations."""
+    document, body = synthetic_chat(chat_id, turns, seed=seed)
+    rng = random.Random(seed)
+    timestamp = document["created_at"]
+    for message in document["chat"]["history"]["messages"].values():
+        timestamp += rng.choice((2, 8, 20, 45, 90, 300, 1800, 7200, 86400))
+        message["timestamp"] = timestamp
+    return document, body
+
+
+async def _measure(module, backend: StubBackend, bodies: dict, mode: str, args, budget: int) -> dict:
+    plugin = module.Filter()
+    plugin.valves.api_base_url = backend.base_url
+    plugin.valves.incremental_injection = False
+    plugin.valves.prefix_compaction = mode
+    plugin.valves.prefix_compaction_last_n = args.last_n
+    plugin.valves.prefix_token_budget = budget
+    added = 0
+    sample = None
+    for chat_id, body in bodies.items():
+        before = sum(_text_length(message) for message in body if message["role"] == "user")
+        result = await plugin.inlet(copy.deepcopy({"messages": body}), __metadata__={"chat_id": chat_id}, __request__=_Request(), __user__={"id": "bench-user"})
+        users = [message for message in result["messages"] if message["role"] == "user"]
+        added += sum(_text_length(message) for message in users) - before
+        if sample is None: sample = [message["content"].split("\n", 1)[0] for message in users[-6:]]
+    await plugin.close()
+    return {"chars": added, "tokens": (added + 3) // 4, "sample": sample}
+
+
+async def run(args) -> None:
+    module = load_filter_module(args.filter)
+    backend = await StubBackend().start()
+    bodies = {}
+    for n in range(args.chats):
+        document, body = _bursty_chat(f"chat-{n}", args.turns, seed=n)
+        backend.add_chat(document)
+        bodies[document["id"]] = body
+
+    baseline = (await _measure(module, backend, bodies, "off", args, 0))["chars"] or 1
+    results = {mode: await _measure(module, backend, bodies, mode, args, args.budget) for mode in MODES}
+    budget = f", token budget {args.budget}" if args.budget else ""
+    print(f"{args.chats} chats x {args.turns} turns, last_n {args.last_n}{budget}")
+    for mode, result in results.items():
+        saved = 1 - result["chars"] / baseline
+        print(f"{mode:<12} prefix chars {result['chars']:>9}   ~tokens {result['tokens']:>8}   saved {saved:6.1%}")
+        if args.sample: print("             " + " | ".join(result["sample"]))
+    await backend.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=500, help="user/assistant pairs per chat")
+    parser.add_argument("--budget", type=int, default=0, help="prefix_token_budget applied to every mode")
+    parser.add_argument("--last-n", type=int, default=20, help="prefix_compaction_last_n for the last_n mode")
+    parser.add_argument("--sample", action="store_true", help="print the prefixes of the last few user messages of the first chat")
+    parser.add_argument("--filter", default=DEFAULT_FILTER, help="path of the filter file to benchmark")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
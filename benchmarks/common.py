@@ -0,0 +1,100 @@
+"""Shared helpers for the benchmark scripts: loading the filter file and generating synthetic chats."""
+import base64
+import importlib.util
+import os
+import random
+import sys
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple, Union
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FILTER = os.path.join(REPO_ROOT, "Time Awareness.py")
+
+
+def load_filter_module(path: str = DEFAULT_FILTER) -> ModuleType:
+    """Imports a filter file the way Open WebUI does: as a standalone module loaded from its path."""
+    name = "time_awareness_bench_" + str(abs(hash(os.path.abspath(path))))
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_chat(
+    chat_id: str,
+    turns: int,
+    image_bytes: int = 0,
+    answer_chars: int = 200,
+    seed: int = 0,
+    start: float = 1_700_000_000,
+    dup_ratio: float = 0.0,
+    multimodal_ratio: Optional[float] = None,
+    branch_ratio: float = 0.0,
+) -> Tuple[Dict, List[Dict]]:
+    """Builds an Open WebUI chat document with `turns` user/assistant pairs and the matching request body.
+
+    - `dup_ratio`: share of user messages that repeat the text of an earlier one ("ok", "continue", ...).
+    - `multimodal_ratio`: share of user messages sent as list content with an `image_url` part. The base64 image of
+      `image_bytes` bytes is stored the way Open WebUI stores it (in the message's `files`). Defaults to every message
+      when `image_bytes` is set, none otherwise.
+    - `branch_ratio`: share of turns that also carry an abandoned branch (an edited user message with its own answer),
+      like the leftovers of edits and regenerations. Only the active branch goes into the request body.
+    """
+    rng = random.Random(seed)
+    if multimodal_ratio is None: multimodal_ratio = 1.0 if image_bytes else 0.0
+    messages: Dict[str, Dict] = {}
+    body: List[Dict] = []
+    user_texts: List[str] = []
+    parent = None
+    timestamp = start
+    image = base64.b64encode(rng.randbytes(image_bytes)).decode() if image_bytes else base64.b64encode(bytes(64)).decode()
+
+    def chance(ratio: float) -> bool:
+        # No random draw for 0 and 1, so chats generated with the default ratios stay identical for a given seed
+        return ratio >= 1 or (ratio > 0 and rng.random() < ratio)
+
+    def add(msg_id: str, parent_id: Optional[str], role: str, text: str, files: Optional[List[Dict]] = None) -> Dict:
+        message = {"id": msg_id, "parentId": parent_id, "childrenIds": [], "role": role, "content": text, "timestamp": int(timestamp), "models": ["bench-model"]}
+        if files: message["files"] = files
+        if parent_id is not None: messages[parent_id]["childrenIds"].append(msg_id)
+        messages[msg_id] = message
+        return message
+
+    for turn in range(turns):
+        if chance(branch_ratio):
+            timestamp += rng.choice((5, 60, 600))
+            add(f"{chat_id}-{turn}-edited", parent, "user", f"draft {turn}: " + "lorem ipsum " * rng.randint(1, 20))
+            timestamp += rng.choice((5, 60))
+            add(f"{chat_id}-{turn}-edited-answer", f"{chat_id}-{turn}-edited", "assistant", "answer " * (answer_chars // 7))
+
+        timestamp += rng.choice((5, 60, 600, 3600, 86400))
+        if user_texts and chance(dup_ratio): text = rng.choice(user_texts)
+        else: text = f"question {turn}: " + "lorem ipsum " * rng.randint(1, 20)
+        user_texts.append(text)
+        request_content: Union[str, List[Dict]] = text
+        files = None
+        if chance(multimodal_ratio):
+            url = f"data:image/png;base64,{image}"
+            files = [{"type": "image", "url": url}]
+            request_content = [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}]
+        add(f"{chat_id}-{turn}-user", parent, "user", text, files)
+        body.append({"role": "user", "content": request_content})
+        parent = f"{chat_id}-{turn}-user"
+
+        timestamp += rng.choice((5, 60, 600, 3600, 86400))
+        answer = "answer " * (answer_chars // 7)
+        add(f"{chat_id}-{turn}-assistant", parent, "assistant", answer)
+        body.append({"role": "assistant", "content": answer})
+        parent = f"{chat_id}-{turn}-assistant"
+
+    document = {
+        "id": chat_id,
+        "user_id": "bench-user",
+        "title": "Benchmark chat",
+        "updated_at": int(timestamp),
+        "created_at": int(start),
+        "chat": {"id": chat_id, "title": "Benchmark chat", "models": ["bench-model"], "history": {"messages": messages, "currentId": parent}, "messages": list(messages.values())},
+    }
+    return document, body
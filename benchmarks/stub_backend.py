@@ -0,0 +1,90 @@
+"""Minimal stand-in for the Open WebUI `/api/v1/chats/{chat_id}` endpoint, with configurable latency and fetch counting."""
+import asyncio
+import hashlib
+import json
+from typing import Dict, Optional
+
+
+class StubBackend:
+    """Serves chat documents over HTTP/1.1 keep-alive on 127.0.0.1.
+
+    `latency` delays every response by that many seconds. `padding` adds that many bytes of filler to every chat
+    document (as an extra top-level field, which the filter has to read past), to test larger payloads without
+    changing the messages. `fetches` and `bytes_sent` count what was actually served per chat id, so benchmarks can
+    check how many requests reached the backend. With `etags`, responses carry an ETag and a matching `If-None-Match`
+    gets an empty 304 (counted in `not_modified`); Open WebUI itself sends no ETags, so this is off by default.
+    `error_status` (e.g. 500) answers every request with that status instead of the chat, as a failing backend would.
+    `body_delay` sends the body in 64 KiB pieces with that many seconds between them, like a large chat on a slow link.
+    """
+
+    def __init__(self, latency: float = 0.0, padding: int = 0, etags: bool = False, error_status: int = 0, body_delay: float = 0.0):
+        self.latency = latency
+        self.padding = padding
+        self.etags = etags
+        self.error_status = error_status
+        self.body_delay = body_delay
+        self.chats: Dict[str, bytes] = {}
+        self.fetches: Dict[str, int] = {}
+        self.bytes_sent = 0
+        self.not_modified = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def total_fetches(self) -> int:
+        return sum(self.fetches.values())
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def add_chat(self, document: Dict) -> None:
+        if self.padding: document = {**document, "meta": {"padding": "x" * self.padding}}
+        self.chats[document["id"]] = json.dumps(document).encode()
+
+    async def start(self) -> "StubBackend":
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode().split("\r\n")
+                headers = dict(line.lower().split(": ", 1) for line in header_lines if ": " in line)
+                path = request_line.split(" ")[1]
+                chat_id = path.rstrip("/").rsplit("/", 1)[-1]
+                if self.latency: await asyncio.sleep(self.latency)
+                payload = self.chats.get(chat_id)
+                self.fetches[chat_id] = self.fetches.get(chat_id, 0) + 1
+                status = "200 OK" if payload is not None else "404 Not Found"
+                extra = ""
+                if self.error_status:
+                    status, payload = f"{self.error_status} Error", b'{"detail":"Stub error"}'
+                elif self.etags and payload is not None:
+                    etag = '"' + hashlib.blake2b(payload, digest_size=8).hexdigest() + '"'
+                    extra = f"ETag: {etag}\r\n"
+                    if headers.get("if-none-match") == etag.lower():
+                        status, payload = "304 Not Modified", b""
+                        self.not_modified += 1
+                payload = payload if payload is not None else b'{"detail":"Not found"}'
+                response_head = f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n{extra}Content-Length: {len(payload)}\r\n\r\n".encode()
+                if self.body_delay:
+                    writer.write(response_head)
+                    for offset in range(0, len(payload), 65536):
+                        await writer.drain()
+                        await asyncio.sleep(self.body_delay)
+                        writer.write(payload[offset:offset + 65536])
+                else:
+                    writer.write(response_head + payload)
+                self.bytes_sent += len(payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,9 @@
+import pytest
+
+from support import FILTER_FILES, load_filter_module
+
+
+@pytest.fixture(params=FILTER_FILES, ids=("en", "zh"))
+def module(request):
+    """The filter module, once for each build. Both must behave the same apart from their strings."""
+    return load_filter_module(request.param)
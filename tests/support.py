@@ -0,0 +1,73 @@
+"""Helpers shared by the tests: both builds of the filter, the stub backend and small chat documents."""
+import copy
+import os
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+from common import load_filter_module, synthetic_chat  # noqa: E402
+from stub_backend import StubBackend  # noqa: E402
+
+# The benchmark helpers are re-exported, so tests only ever import from here
+__all__ = [
+    "EARLY", "FILTER_FILES", "LATER", "Request", "StubBackend", "branch_body", "chat_document", "load_filter_module", "new_filter", "send",
+    "synthetic_chat", "user_texts",
+]
+
+FILTER_FILES = (os.path.join(REPO_ROOT, "Time Awareness.py"), os.path.join(REPO_ROOT, "时间感知.py"))
+
+# 1970-01-01 00:01:40 UTC, and the same time of day three days later
+EARLY = 100
+LATER = 3 * 86400 + 100
+
+
+class Request:
+    headers = {"authorization": "Bearer test.jwt.token"}
+
+
+def chat_document(chat_id: str, messages: Sequence[Tuple[str, Optional[str], str, str, float]], current_id: Optional[str] = None, updated_at: Optional[int] = None) -> Dict:
+    """An Open WebUI chat document. `messages` lists (id, parent id, role, content, timestamp); `current_id` defaults to the last one."""
+    history = {}
+    for msg_id, parent_id, role, content, timestamp in messages:
+        history[msg_id] = {"id": msg_id, "parentId": parent_id, "childrenIds": [], "role": role, "content": content, "timestamp": timestamp}
+        if parent_id is not None: history[parent_id]["childrenIds"].append(msg_id)
+    if current_id is None: current_id = messages[-1][0]
+    if updated_at is None: updated_at = int(max(message[4] for message in messages))
+    return {"id": chat_id, "user_id": "test-user", "updated_at": updated_at, "chat": {"history": {"messages": history, "currentId": current_id}}}
+
+
+def branch_body(document: Dict) -> List[Dict]:
+    """The request body Open WebUI sends for the active branch of `document`: role and content from the root to `currentId`."""
+    history = document["chat"]["history"]
+    branch = []
+    node = history["currentId"]
+    while node is not None:
+        message = history["messages"][node]
+        branch.append({"role": message["role"], "content": copy.deepcopy(message["content"])})
+        node = message["parentId"]
+    return branch[::-1]
+
+
+def new_filter(module, backend: Optional[StubBackend] = None, **valves):
+    plugin = module.Filter()
+    if backend is not None: plugin.valves.api_base_url = backend.base_url
+    for name, value in valves.items(): setattr(plugin.valves, name, value)
+    return plugin
+
+
+async def send(plugin, chat_id: Optional[str], messages: List[Dict], user_id: str = "test-user", timezone: str = "UTC", request=None, **extra) -> List[Dict]:
+    """Runs one inlet on a copy of `messages` and returns the messages as the model would receive them. `request` defaults to one carrying a JWT."""
+    metadata = {"chat_id": chat_id, "variables": {"{{CURRENT_TIMEZONE}}": timezone}} if chat_id else {"variables": {"{{CURRENT_TIMEZONE}}": timezone}}
+    body = await plugin.inlet({"messages": copy.deepcopy(messages)}, __metadata__=metadata, __request__=request or Request(), __user__={"id": user_id}, **extra)
+    return body["messages"]
+
+
+def user_texts(messages: List[Dict]) -> List[str]:
+    texts = []
+    for message in messages:
+        if message["role"] != "user": continue
+        content = message["content"]
+        texts.append(content if isinstance(content, str) else "\n".join(part.get("text", "") for part in content if part.get("type") == "text"))
+    return texts
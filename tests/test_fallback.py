@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+from support import EARLY, StubBackend, branch_body, chat_document, new_filter, send
+
+DOCUMENT = chat_document("chat", [
+    ("u1", None, "user", "hello", EARLY), ("a1", "u1", "assistant", "hi", EARLY + 10),
+    ("u2", "a1", "user", "next", EARLY + 20), ("a2", "u2", "assistant", "sure", EARLY + 30),
+    ("u3", "a2", "user", "now", EARLY + 40),
+])
+
+
+class NoAuthRequest:
+    headers = {}
+
+
+def _assert_only_current_stamped(messages):
+    assert [message["content"] for message in messages[:-1]] == ["hello", "hi", "next", "sure"]
+    assert messages[-1]["content"].startswith("[") and messages[-1]["content"].endswith("]\nnow")
+
+
+def test_slow_backend_degrades_within_the_budget(module):
+    async def scenario():
+        backend = await StubBackend(latency=2.0).start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, history_latency_budget=0.2)
+        started = time.monotonic()
+        messages = await send(plugin, "chat", branch_body(DOCUMENT))
+        elapsed = time.monotonic() - started
+        await plugin.close()
+        await backend.close()
+        return messages, elapsed
+
+    messages, elapsed = asyncio.run(scenario())
+    assert elapsed < 1.5
+    _assert_only_current_stamped(messages)
+
+
+@pytest.mark.parametrize("failure", ["unreachable", "server_error", "not_found", "missing_jwt"])
+def test_failed_fetch_degrades_like_a_timeout(module, failure):
+    async def scenario():
+        backend = await StubBackend(error_status=500 if failure == "server_error" else 0).start()
+        if failure != "not_found": backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend)
+        if failure == "unreachable": await backend.close()
+        messages = await send(plugin, "chat", branch_body(DOCUMENT), request=NoAuthRequest() if failure == "missing_jwt" else None)
+        await plugin.close()
+        await backend.close()
+        return messages
+
+    _assert_only_current_stamped(asyncio.run(scenario()))
+
+
+def test_open_breaker_skips_the_backend(module):
+    async def scenario():
+        backend = await StubBackend(error_status=503).start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, circuit_breaker_failures=2, circuit_breaker_cooldown_seconds=60)
+        results = [await send(plugin, "chat", branch_body(DOCUMENT)) for _ in range(4)]
+        await plugin.close()
+        await backend.close()
+        return results, backend.total_fetches
+
+    results, fetches = asyncio.run(scenario())
+    assert fetches == 2
+    for messages in results: _assert_only_current_stamped(messages)
+
+
+def test_failure_keeps_what_earlier_turns_resolved(module):
+    async def scenario():
+        backend = await StubBackend().start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, incremental_injection=True)
+        body = branch_body(DOCUMENT)
+        first = await send(plugin, "chat", body[:3])
+        backend.error_status = 500
+        second = await send(plugin, "chat", body)
+        await plugin.close()
+        await backend.close()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first[0]["content"].startswith("[1970-01-01, ") and first[0]["content"].endswith("00:01:40]\nhello")
+    # "hello" comes from the earlier turn, "next" would need the history
+    assert second[0] == first[0]
+    assert second[2]["content"] == "next"
+    assert second[-1]["content"].endswith("]\nnow")
+
+
+def test_missing_chats_do_not_open_the_breaker(module):
+    async def scenario():
+        backend = await StubBackend().start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, circuit_breaker_failures=3)
+        # Deleted or temporary chats of three users answer 404
+        for n in range(3): await send(plugin, f"gone-{n}", branch_body(DOCUMENT), user_id=f"user-{n}")
+        messages = await send(plugin, "chat", branch_body(DOCUMENT), user_id="user-3")
+        stats = plugin.history_cache_stats()
+        await plugin.close()
+        await backend.close()
+        return messages, stats, backend.total_fetches
+
+    messages, stats, fetches = asyncio.run(scenario())
+    assert stats["circuit_rejected"] == 0 and fetches == 4
+    assert messages[0]["content"].endswith("00:01:40]\nhello")
+
+
+def test_slowness_is_measured_to_the_first_byte(module):
+    async def scenario(backend):
+        await backend.start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, circuit_breaker_failures=1, circuit_breaker_slow_seconds=0.1, incremental_injection=False)
+        results = [await send(plugin, "chat", branch_body(DOCUMENT)) for _ in range(2)]
+        stats = plugin.history_cache_stats()
+        await plugin.close()
+        await backend.close()
+        return results, stats
+
+    # A large chat that takes 0.3 s to download but starts at once is not slow
+    results, stats = asyncio.run(scenario(StubBackend(padding=300000, body_delay=0.06)))
+    assert stats["circuit_rejected"] == 0
+    assert all(messages[0]["content"].endswith("00:01:40]\nhello") for messages in results)
+    # A response that takes 0.3 s to start is
+    results, stats = asyncio.run(scenario(StubBackend(latency=0.3)))
+    assert stats["circuit_rejected"] == 1
+    assert results[1][0]["content"] == "hello"
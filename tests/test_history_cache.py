@@ -0,0 +1,77 @@
+import asyncio
+
+from support import EARLY, LATER, StubBackend, branch_body, chat_document, new_filter, send
+
+
+def _edited_chat():
+    """ "ok" sent at 00:01:40, then edited to the same text three days later, which starts a new branch."""
+    original = [("u1", None, "user", "ok", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)]
+    edited = original + [("u1b", None, "user", "ok", LATER), ("a1b", "u1b", "assistant", "fine", LATER + 10), ("u2b", "a1b", "user", "more", LATER + 20)]
+    return chat_document("chat", original), chat_document("chat", edited)
+
+
+def test_cached_history_is_revalidated_after_same_text_edit(module):
+    async def scenario():
+        backend = await StubBackend().start()
+        plugin = new_filter(module, backend, incremental_injection=False)
+        before, after = _edited_chat()
+        backend.add_chat(before)
+        first = await send(plugin, "chat", branch_body(before))
+        backend.add_chat(after)
+        second = await send(plugin, "chat", branch_body(after))
+        stats = plugin.history_cache_stats()
+        await plugin.close()
+        await backend.close()
+        return first, second, backend.total_fetches, stats
+
+    first, second, fetches, stats = asyncio.run(scenario())
+    assert first[0]["content"].startswith("[1970-01-01, ") and "00:01:40]" in first[0]["content"]
+    assert second[0]["content"].startswith("[1970-01-04, ") and "00:01:40]" in second[0]["content"]
+    # Both turns downloaded the chat, so the cached copy saved nothing
+    assert fetches == 2
+    assert stats["hits"] == 0 and stats["misses"] == 2
+
+
+def test_unchanged_chat_is_revalidated_without_download(module):
+    async def scenario():
+        backend = await StubBackend(etags=True).start()
+        plugin = new_filter(module, backend, incremental_injection=False)
+        document, _ = _edited_chat()
+        backend.add_chat(document)
+        first = await send(plugin, "chat", branch_body(document))
+        sent = backend.bytes_sent
+        second = await send(plugin, "chat", branch_body(document))
+        stats = plugin.history_cache_stats()
+        await plugin.close()
+        await backend.close()
+        return first, second, backend, sent, stats
+
+    first, second, backend, sent, stats = asyncio.run(scenario())
+    assert first[0] == second[0]
+    assert backend.total_fetches == 2 and backend.not_modified == 1
+    assert backend.bytes_sent == sent
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_in_place_edit_is_hashed_again(module):
+    # Open WebUI's "Save" edit keeps the message id and timestamp and only changes the text (and `updated_at`)
+    before = chat_document("chat", [("u1", None, "user", "teh plan", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)])
+    after = chat_document("chat", [
+        ("u1", None, "user", "the plan", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20),
+        ("a2", "u2", "assistant", "fine", EARLY + 30), ("u3", "a2", "user", "more", EARLY + 40),
+    ], updated_at=LATER)
+
+    async def scenario():
+        backend = await StubBackend().start()
+        plugin = new_filter(module, backend)
+        backend.add_chat(before)
+        await send(plugin, "chat", branch_body(before))
+        backend.add_chat(after)
+        messages = await send(plugin, "chat", branch_body(after))
+        await plugin.close()
+        await backend.close()
+        return messages
+
+    messages = asyncio.run(scenario())
+    assert messages[0]["content"].startswith("[1970-01-01, ") and messages[0]["content"].endswith("00:01:40]\nthe plan")
+    assert messages[2]["content"] == "[00:02:00]\nnext"
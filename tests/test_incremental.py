@@ -0,0 +1,95 @@
+import asyncio
+import random
+
+import pytest
+
+from support import EARLY, LATER, StubBackend, branch_body, chat_document, new_filter, send, synthetic_chat
+
+COMPACTION = [
+    {"prefix_compaction": "off"},
+    {"prefix_compaction": "last_n", "prefix_compaction_last_n": 3},
+    {"prefix_compaction": "minute_runs"},
+    {"prefix_compaction": "relative"},
+    {"prefix_compaction": "off", "prefix_token_budget": 40},
+]
+
+
+async def _side_by_side(module, documents, bodies, **valves):
+    """Sends each body to a filter with incremental injection and to one without; `documents[n]` is served for `bodies[n]`."""
+    backend = await StubBackend().start()
+    incremental = new_filter(module, backend, incremental_injection=True, **valves)
+    full = new_filter(module, backend, incremental_injection=False, **valves)
+    results = []
+    for document, body in zip(documents, bodies):
+        backend.add_chat(document)
+        results.append((await send(incremental, "chat", body), await send(full, "chat", body)))
+    await incremental.close()
+    await full.close()
+    await backend.close()
+    return results
+
+
+@pytest.mark.parametrize("valves", COMPACTION, ids=lambda valves: "-".join(str(value) for value in valves.values()))
+def test_incremental_matches_full_pass_on_generated_chats(module, valves):
+    rng = random.Random(11)
+    for seed in range(3):
+        document, body = synthetic_chat("chat", 25, seed=seed, dup_ratio=0.4, branch_ratio=0.3, multimodal_ratio=0.2)
+        # One turn per user message, with the occasional edit of an earlier message to the text of another
+        bodies = []
+        for end in range(1, len(body) + 1, 2):
+            turn = body[:end]
+            if end > 5 and rng.random() < 0.2:
+                turn = list(turn)
+                turn[rng.randrange(0, end - 1, 2)] = {"role": "user", "content": turn[rng.randrange(0, end - 1, 2)]["content"]}
+            bodies.append(turn)
+        for incremental, full in asyncio.run(_side_by_side(module, [document] * len(bodies), bodies, **valves)):
+            # The current message carries the time of the request, which differs between the two filters
+            assert incremental[:-1] == full[:-1]
+
+
+def test_branch_switch_with_the_same_texts_is_not_reused(module):
+    # Two branches whose every message reads the same: only the message ids and timestamps differ
+    first = [("u1", None, "user", "ok", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)]
+    second = [("u1b", None, "user", "ok", LATER), ("a1b", "u1b", "assistant", "sure", LATER + 10), ("u2b", "a1b", "user", "next", LATER + 20)]
+    on_first = chat_document("chat", first + second, current_id="u2")
+    # Switching branches saves the chat, which moves `updated_at`
+    on_second = chat_document("chat", first + second, current_id="u2b", updated_at=LATER + 100)
+    continued = chat_document("chat", first + second + [("a2b", "u2b", "assistant", "fine", LATER + 30), ("u3b", "a2b", "user", "more", LATER + 200)])
+    documents = [on_first, on_second, continued]
+    results = asyncio.run(_side_by_side(module, documents, [branch_body(document) for document in documents]))
+    assert results[0][0][0]["content"].startswith("[1970-01-01, ")
+    assert results[1][0][0]["content"].startswith("[1970-01-04, ")
+    assert results[2][0][2]["content"] == "[00:02:00]\nnext"
+    for incremental, full in results:
+        assert incremental[:-1] == full[:-1]
+
+
+def test_same_text_edit_with_new_replies_is_not_reused(module):
+    original = [("u1", None, "user", "ok", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)]
+    edited = original + [("u1b", None, "user", "ok", LATER), ("a1b", "u1b", "assistant", "fine", LATER + 10), ("u2b", "a1b", "user", "more", LATER + 20)]
+    documents = [chat_document("chat", original), chat_document("chat", edited)]
+    results = asyncio.run(_side_by_side(module, documents, [branch_body(document) for document in documents]))
+    assert results[1][0][0]["content"].startswith("[1970-01-04, ") and "00:01:40]" in results[1][0][0]["content"]
+    assert results[1][0][:-1] == results[1][1][:-1]
+
+
+@pytest.mark.parametrize("with_ids", [False, True])
+def test_message_ids_in_the_request_spare_the_id_check(module, with_ids):
+    document = chat_document("chat", [("u1", None, "user", "hello", EARLY), ("a1", "u1", "assistant", "hi", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)])
+    body = branch_body(document)
+    if with_ids:
+        for message, msg_id in zip(body, ["u1", "a1", "u2"]): message["id"] = msg_id
+
+    async def scenario():
+        backend = await StubBackend().start()
+        backend.add_chat(document)
+        plugin = new_filter(module, backend, incremental_injection=True)
+        # The second turn regenerates the answer: only the current message is pending
+        results = [await send(plugin, "chat", body) for _ in range(2)]
+        await plugin.close()
+        await backend.close()
+        return results, backend.total_fetches
+
+    results, fetches = asyncio.run(scenario())
+    assert fetches == (1 if with_ids else 2)
+    assert results[1][0] == results[0][0] and results[0][0]["content"].endswith("00:01:40]\nhello")
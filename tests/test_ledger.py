@@ -0,0 +1,58 @@
+import asyncio
+
+from support import EARLY, LATER, StubBackend, branch_body, chat_document, new_filter, send
+
+
+async def _turns(module, tmp_path, documents, current_sends=()):
+    """Sends the active branch of each document in turn, with the ledger on and incremental injection off.
+
+    `current_sends` maps a turn number to a body sent right before that turn, as when a message is edited and sent.
+    """
+    backend = await StubBackend().start()
+    plugin = new_filter(module, backend, ledger_enabled=True, ledger_path=str(tmp_path / "ledger.db"), incremental_injection=False)
+    results, fetches = [], []
+    for n, document in enumerate(documents):
+        backend.add_chat(document)
+        for body in dict(current_sends).get(n, ()): await send(plugin, "chat", body)
+        results.append(await send(plugin, "chat", branch_body(document)))
+        fetches.append(backend.total_fetches)
+    await plugin.close()
+    await backend.close()
+    return results, fetches
+
+
+def test_edited_branch_does_not_reuse_abandoned_timestamps(module, tmp_path):
+    original = [
+        ("u1", None, "user", "ok", EARLY), ("a1", "u1", "assistant", "A1", EARLY + 10),
+        ("u2", "a1", "user", "a", EARLY + 60), ("a2", "u2", "assistant", "A2", EARLY + 70),
+        ("u3", "a2", "user", "ok", EARLY + 120), ("a3", "u3", "assistant", "A3", EARLY + 130),
+        ("u4", "a3", "user", "next", EARLY + 180),
+    ]
+    # "a" is edited to "c" three days later, and "ok" is sent again on the new branch
+    edited = original + [
+        ("u2b", "a1", "user", "c", LATER), ("a2b", "u2b", "assistant", "C2", LATER + 10),
+        ("u3b", "a2b", "user", "ok", LATER + 60), ("a3b", "u3b", "assistant", "A3", LATER + 70),
+        ("u4b", "a3b", "user", "then", LATER + 120),
+    ]
+    results, _ = asyncio.run(_turns(module, tmp_path, [chat_document("chat", original), chat_document("chat", edited)]))
+    assert results[0][4]["content"] == "[00:03:40]\nok"
+    assert results[1][2]["content"].startswith("[1970-01-04, ")
+    assert results[1][4]["content"] == "[00:02:40]\nok"
+
+
+def test_same_text_edit_marks_the_entry_ambiguous(module, tmp_path):
+    original = [("u1", None, "user", "ok", EARLY), ("a1", "u1", "assistant", "sure", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)]
+    # Same text, same reply: only the timestamps tell the two branches apart
+    edited = original + [("u1b", None, "user", "ok", LATER), ("a1b", "u1b", "assistant", "sure", LATER + 10), ("u2b", "a1b", "user", "more", LATER + 20)]
+    edit_sent = [{"role": "user", "content": "ok"}]
+    results, _ = asyncio.run(_turns(module, tmp_path, [chat_document("chat", original), chat_document("chat", edited)], {1: [edit_sent]}))
+    assert results[0][0]["content"].startswith("[1970-01-01, ")
+    assert results[1][0]["content"].startswith("[1970-01-04, ")
+
+
+def test_continued_chat_resolves_from_the_ledger(module, tmp_path):
+    first = [("u1", None, "user", "hello", EARLY), ("a1", "u1", "assistant", "hi", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)]
+    second = first + [("a2", "u2", "assistant", "sure", EARLY + 30), ("u3", "a2", "user", "more", EARLY + 40)]
+    results, fetches = asyncio.run(_turns(module, tmp_path, [chat_document("chat", first), chat_document("chat", second)]))
+    assert fetches == [1, 1]
+    assert results[1][0]["content"] == results[0][0]["content"]
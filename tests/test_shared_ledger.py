@@ -0,0 +1,113 @@
+import asyncio
+import concurrent.futures
+import sqlite3
+
+import pytest
+
+from support import EARLY, StubBackend, branch_body, chat_document, new_filter, send
+
+
+def _document(chat_id, offset=0):
+    return chat_document(chat_id, [
+        ("u1", None, "user", f"hello {chat_id}", EARLY + offset), ("a1", "u1", "assistant", "hi", EARLY + offset + 10),
+        ("u2", "a1", "user", "next", EARLY + offset + 20), ("a2", "u2", "assistant", "sure", EARLY + offset + 30),
+        ("u3", "a2", "user", "now", EARLY + offset + 40),
+    ])
+
+
+def _workers(module, backend, path, count=2, **valves):
+    """Filters standing in for separate Open WebUI worker processes sharing one ledger file."""
+    return [new_filter(module, backend, ledger_enabled=True, ledger_path=path, **valves) for _ in range(count)]
+
+
+def test_timestamps_stamped_by_one_worker_spare_the_fetch_on_another(module, tmp_path):
+    document = _document("chat")
+
+    async def scenario():
+        backend = await StubBackend().start()
+        backend.add_chat(document)
+        first, second = _workers(module, backend, str(tmp_path / "ledger.db"))
+        on_first = await send(first, "chat", branch_body(document))
+        on_second = await send(second, "chat", branch_body(document))
+        for plugin in (first, second): await plugin.close()
+        await backend.close()
+        return on_first, on_second, backend.total_fetches
+
+    on_first, on_second, fetches = asyncio.run(scenario())
+    assert fetches == 1
+    assert on_second[:-1] == on_first[:-1] and on_first[0]["content"].endswith("00:01:40]\nhello chat")
+
+
+def test_concurrent_workers_share_one_ledger(module, tmp_path):
+    documents = [_document(f"chat-{n}", offset=n * 1000) for n in range(12)]
+    path = str(tmp_path / "ledger.db")
+
+    async def scenario():
+        backend = await StubBackend(latency=0.01).start()
+        for document in documents: backend.add_chat(document)
+        workers = _workers(module, backend, path)
+        # Both workers serve every chat at the same time, so their ledger writes interleave
+        results = await asyncio.gather(*(send(worker, document["id"], branch_body(document)) for document in documents for worker in workers))
+        fetched = backend.total_fetches
+        late = new_filter(module, backend, ledger_enabled=True, ledger_path=path)
+        rerun = [await send(late, document["id"], branch_body(document)) for document in documents]
+        for plugin in workers + [late]: await plugin.close()
+        await backend.close()
+        return results, rerun, fetched, backend.total_fetches
+
+    results, rerun, fetched, fetches = asyncio.run(scenario())
+    assert fetched <= 2 * len(documents) and fetches == fetched
+    for n, document in enumerate(documents):
+        assert results[2 * n][:-1] == results[2 * n + 1][:-1] == rerun[n][:-1]
+        assert rerun[n][0]["content"].endswith(f"]\nhello {document['id']}")
+
+
+def test_conflicting_recordings_from_two_workers_stay_ambiguous(module, tmp_path):
+    first, second = _workers(module, None, str(tmp_path / "ledger.db"))
+    ledgers = [first._get_ledger(), second._get_ledger()]
+    fingerprints = [bytes([n]) * 16 for n in range(200)]
+
+    def record(worker, fingerprint):
+        # The second worker saw every message three days after the first: same fingerprints, different messages
+        ledgers[worker].record("test-user", "chat", [(fingerprint, EARLY + worker * 3 * 86400)])
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(record, [0, 1] * len(fingerprints), [fp for fp in fingerprints for _ in range(2)]))
+    known = ledgers[0].lookup("test-user", "chat")
+    asyncio.run(first.close())
+    asyncio.run(second.close())
+    assert known == {fingerprint: None for fingerprint in fingerprints}
+
+
+@pytest.mark.parametrize("limit", ["retention_days", "max_entries"])
+def test_compaction_by_one_worker_evicts_for_all(module, tmp_path, limit):
+    path = str(tmp_path / "ledger.db")
+    old, new = _document("old"), _document("new", offset=1000)
+
+    async def scenario():
+        backend = await StubBackend().start()
+        for document in (old, new): backend.add_chat(document)
+        first, second = _workers(module, backend, path, ledger_retention_days=90.0, ledger_max_entries=0)
+        await send(first, "old", branch_body(old))
+        await first.close()
+        if limit == "retention_days":
+            # Ages the first worker's entries past the retention window
+            conn = sqlite3.connect(path)
+            conn.execute("UPDATE stamps SET recorded_at = recorded_at - 100 * 86400")
+            conn.commit()
+            conn.close()
+        else:
+            second.valves.ledger_max_entries = 3
+        await send(second, "new", branch_body(new))
+        left = {chat_id: second._get_ledger().lookup("test-user", chat_id) for chat_id in ("old", "new")}
+        fetched = backend.total_fetches
+        # The evicted chat is resolved from its history again
+        messages = await send(second, "old", branch_body(old))
+        await second.close()
+        await backend.close()
+        return left, fetched, backend.total_fetches, messages
+
+    left, fetched, fetches, messages = asyncio.run(scenario())
+    assert left["old"] == {} and len(left["new"]) == 3
+    assert fetches == fetched + 1
+    assert messages[0]["content"].endswith("00:01:40]\nhello old")
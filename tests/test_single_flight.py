@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from support import EARLY, StubBackend, branch_body, chat_document, new_filter, send
+
+
+def test_concurrent_inlets_share_one_fetch(module):
+    async def scenario():
+        backend = await StubBackend(latency=0.2).start()
+        plugin = new_filter(module, backend)
+        document = chat_document("chat", [("u1", None, "user", "hello", EARLY), ("a1", "u1", "assistant", "hi", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)])
+        backend.add_chat(document)
+        results = await asyncio.gather(*(send(plugin, "chat", branch_body(document)) for _ in range(20)))
+        await plugin.close()
+        await backend.close()
+        return results, backend.total_fetches
+
+    results, fetches = asyncio.run(scenario())
+    assert fetches == 1
+    assert all(messages[0] == results[0][0] for messages in results)
+    assert results[0][0]["content"].startswith("[1970-01-01, ")
+
+
+def test_error_reaches_every_waiter(module):
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("backend down")
+
+    async def scenario():
+        flights = module._SingleFlight()
+        return flights, await asyncio.gather(*(flights.run("chat", fail) for _ in range(5)), return_exceptions=True)
+
+    flights, outcomes = asyncio.run(scenario())
+    assert len(calls) == 1 and flights.coalesced == 4
+    assert all(isinstance(outcome, ValueError) and outcome is outcomes[0] for outcome in outcomes)
+    assert not flights._calls
+
+
+def test_cancelled_waiter_leaves_the_others_running(module):
+    calls = []
+
+    async def scenario():
+        flights = module._SingleFlight()
+        release = asyncio.Event()
+
+        async def load():
+            calls.append(1)
+            await release.wait()
+            return "history"
+
+        waiters = [asyncio.ensure_future(flights.run("chat", load)) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError): await waiters[0]
+        return await asyncio.gather(*waiters[1:])
+
+    assert asyncio.run(scenario()) == ["history", "history"]
+    assert len(calls) == 1
+
+
+def test_last_waiter_cancelled_cancels_the_fetch(module):
+    async def scenario():
+        flights = module._SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def reload():
+            return "fresh"
+
+        async def load():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.ensure_future(flights.run("chat", load))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        # A caller arriving afterwards starts a fresh fetch instead of joining the cancelled one
+        return await flights.run("chat", reload)
+
+    assert asyncio.run(scenario()) == "fresh"
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+from support import EARLY, StubBackend, branch_body, chat_document, new_filter, send
+
+DOCUMENT = chat_document("chat", [("u1", None, "user", "hello", EARLY), ("a1", "u1", "assistant", "hi", EARLY + 10), ("u2", "a1", "user", "next", EARLY + 20)])
+
+
+def _database(path, document=DOCUMENT, user_id="test-user"):
+    """A minimal copy of Open WebUI's `chat` table holding `document`."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE chat (id TEXT PRIMARY KEY, user_id TEXT, chat JSON, updated_at BIGINT)")
+    conn.execute("INSERT INTO chat VALUES (?, ?, ?, ?)", (document["id"], user_id, json.dumps(document["chat"]), document["updated_at"]))
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def test_reads_the_history_and_revalidates_by_updated_at(module, tmp_path):
+    provider = module._SqliteHistoryProvider(_database(tmp_path / "webui.db"))
+    data, etag = asyncio.run(provider.fetch("chat", "test-user", None, None))
+    assert data["chat"]["history"] == DOCUMENT["chat"]["history"]
+    assert data["updated_at"] == DOCUMENT["updated_at"] and etag == f"sqlite:{DOCUMENT['updated_at']}"
+    assert asyncio.run(provider.fetch("chat", "test-user", None, etag)) == (None, etag)
+
+
+def test_unknown_user_or_database_reads_nothing(module, tmp_path):
+    provider = module._SqliteHistoryProvider(_database(tmp_path / "webui.db"))
+    assert asyncio.run(provider.fetch("chat", "someone-else", None, None)) is None
+    assert asyncio.run(provider.fetch("other-chat", "test-user", None, None)) is None
+    assert asyncio.run(module._SqliteHistoryProvider(str(tmp_path / "missing.db")).fetch("chat", "test-user", None, None)) is None
+
+
+@pytest.mark.parametrize("case", ["own_chat", "other_user", "missing_file"])
+def test_filter_falls_back_to_http(module, tmp_path, case):
+    database = str(tmp_path / "missing.db") if case == "missing_file" else _database(tmp_path / "webui.db", user_id="test-user" if case == "own_chat" else "someone-else")
+
+    async def scenario():
+        backend = await StubBackend().start()
+        backend.add_chat(DOCUMENT)
+        plugin = new_filter(module, backend, history_provider="sqlite", database_path=database)
+        messages = await send(plugin, "chat", branch_body(DOCUMENT))
+        await plugin.close()
+        await backend.close()
+        return messages, backend.total_fetches
+
+    messages, fetches = asyncio.run(scenario())
+    assert fetches == (0 if case == "own_chat" else 1)
+    assert messages[0]["content"].startswith("[1970-01-01, ") and messages[0]["content"].endswith("00:01:40]\nhello")
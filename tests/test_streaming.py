@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+import pytest
+
+from support import new_filter, synthetic_chat
+
+
+async def _chunks(raw: bytes, size: int):
+    for offset in range(0, len(raw), size):
+        yield raw[offset:offset + size]
+
+
+def test_offloaded_parse_matches_inline_parse(module):
+    document, _ = synthetic_chat("chat", 40, image_bytes=5000, seed=2, dup_ratio=0.3, branch_ratio=0.3)
+    raw = json.dumps(document).encode()
+
+    async def scenario():
+        plugin = new_filter(module)
+        inline = await module._stream_chat_document(_chunks(raw, 1000))
+        offloaded = await module._stream_chat_document(_chunks(raw, 1000), plugin._offload)
+        await plugin.close()
+        return inline, offloaded
+
+    inline, offloaded = asyncio.run(scenario())
+    assert offloaded == inline
+    assert inline["chat"]["history"]["currentId"] == document["chat"]["history"]["currentId"]
+
+
+def test_offloaded_parse_reports_a_broken_download(module):
+    async def broken():
+        yield b'{"chat": {"history": {"messages": {'
+        raise ConnectionError("connection reset")
+
+    async def scenario():
+        plugin = new_filter(module)
+        try:
+            await module._stream_chat_document(broken(), plugin._offload)
+        finally:
+            await plugin.close()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import random
+from collections import defaultdict
+
+from support import new_filter, synthetic_chat
+
+
+def _reference_pops(entries, order):
+    """What the original `defaultdict(list)` + `pop(0)` lookup returned for the texts in `order`."""
+    by_text = defaultdict(list)
+    for timestamp, text in sorted(entries):
+        by_text[text].append(timestamp)
+    return [by_text[text].pop(0) if by_text[text] else None for text in order]
+
+
+def test_duplicate_heavy_chat_pops_each_text_in_time_order(module):
+    rng = random.Random(1)
+    texts = ["ok", "continue", "thanks", "[log] " + "x" * 200]
+    entries = [(1000 + n, rng.choice(texts)) for n in range(10000)]
+    rng.shuffle(entries)
+    index = module._TimestampIndex((timestamp, module._content_digest(text)) for timestamp, text in entries)
+    order = [rng.choice(texts + ["never sent"]) for _ in range(10500)]
+    assert [index.pop(module._content_digest(text)) for text in order] == _reference_pops(entries, order)
+
+
+def test_ten_thousand_message_chat_resolves_every_user_message(module):
+    document, body = synthetic_chat("chat", 5000, seed=3, dup_ratio=0.3)
+    history = new_filter(module)._parse_chat_history(document, None)
+    index = module._TimestampIndex(history["messages"].values())
+    stored = [message["timestamp"] for message in document["chat"]["history"]["messages"].values() if message["role"] == "user"]
+    assert [index.pop(module._content_digest(message["content"])) for message in body if message["role"] == "user"] == stored
+    assert len(index) == 0
+
+
+def test_index_accepts_missing_timestamps(module):
+    digest = module._content_digest("ok")
+    index = module._TimestampIndex([(5, digest), (None, digest)])
+    assert index.pop(digest) is None and index.pop(digest) == 5 and index.pop(digest) is None
+
+
+def test_multi_part_content_digests_like_joined_text(module):
+    digest = module._content_digest
+    parts = [{"type": "text", "text": "first"}, {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}, {"type": "text", "text": "second"}]
+    assert digest(parts) == digest("first\nsecond")
+    assert digest([{"type": "text", "text": "first"}]) == digest("first")
+    assert digest([{"type": "text"}, {"type": "text", "text": "x"}]) == digest("\nx")
+    assert digest(None) == digest("") == digest([]) == digest([{"type": "image_url", "image_url": {}}])
+    assert digest("first\nsecond") != digest("first second")
+    assert len(digest("\ud800 lone surrogate")) == 16
+
+
+def test_content_starts_with_bracket(module):
+    starts = module._content_starts_with_bracket
+    assert starts("[2025-01-01] already stamped")
+    assert starts("  \n [x")
+    assert not starts("x [y]")
+    assert not starts("") and not starts("   ") and not starts(None)
+    assert starts([{"type": "image_url", "image_url": {}}, {"type": "text", "text": "  "}, {"type": "text", "text": "[a"}])
+    assert not starts([{"type": "text", "text": "a"}, {"type": "text", "text": "[b"}])
+    assert not starts([{"type": "image_url", "image_url": {}}])
@@ -5,13 +5,21 @@ author_url: https://github.com/CookSleep
 description: 为对话中的所有用户消息（包括历史消息）注入准确的时间上下文。它能智能处理各种消息类型并优化可读性。支持多用户，并自动获取认证信息和用户时区，无需手动配置。
 version: 1.1
 """
+import os
+import re
 import time
+import asyncio
+import bisect
+import sqlite3
 import datetime
+import concurrent.futures
+import threading
+import hashlib
 import logging
 import json
 import zoneinfo
-from typing import Any, Optional, Dict, List, Callable, Union
-from collections import defaultdict
+from typing import Any, AsyncIterator, Optional, Dict, List, Callable, Tuple, Union
+from collections import Counter, OrderedDict, deque
 from pydantic import BaseModel, Field
 
 # --- httpx (如果环境中没有，需要安装 `pip install httpx`) ---
@@ -20,6 +28,18 @@ try:
 except ImportError:
     httpx = None
 
+# --- ijson（可选，安装 `pip install ijson` 后启用流式解析聊天历史）---
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# --- redis（可选，安装 `pip install redis` 后可使用 "redis" 台账后端）---
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # --- 日志记录设置 ---
 LOGGER = logging.getLogger("TimeAwareness_v1_1")
 LOGGER.setLevel(logging.INFO)
@@ -31,6 +51,681 @@ if not LOGGER.handlers:
     LOGGER.addHandler(handler)
 
 
+class _HistoryCache:
+    """解析后的聊天历史的内存 LRU + TTL 缓存，以 (用户, chat_id) 为键。"""
+
+    def __init__(self):
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._message_count = 0
+        # `hits` 统计因缓存副本而省去的下载（后端报告对话未变化），`misses` 统计完整下载
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[str, str], ttl: float) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None: return None
+        if ttl > 0 and time.monotonic() - entry["stored_at"] > ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple[str, str], entry: Dict, max_chats: int, max_messages: int) -> None:
+        self._remove(key)
+        entry["stored_at"] = time.monotonic()
+        self._entries[key] = entry
+        self._message_count += len(entry["messages"])
+        while self._entries and (len(self._entries) > max_chats or self._message_count > max_messages):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._message_count = 0
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._message_count -= len(entry["messages"])
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._entries), "messages": self._message_count, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class _LruCache:
+    """用于保存每个对话状态的小型 LRU 映射。"""
+
+    def __init__(self):
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        value = self._entries.get(key)
+        if value is not None: self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any, max_entries: int) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(max_entries, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _Metrics:
+    """开启 `metrics_enabled` 时收集的各阶段耗时、计数器和对话规模直方图。"""
+
+    TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counters: Counter = Counter()
+        self._histograms: Dict[Tuple[str, str], List] = {}
+        self.last_logged = time.monotonic()
+
+    def observe(self, name: str, label: str, value: float, buckets: Tuple = TIME_BUCKETS) -> None:
+        histogram = self._histograms.get((name, label))
+        if histogram is None: histogram = self._histograms[(name, label)] = [buckets, [0] * (len(buckets) + 1), 0.0]
+        histogram[1][bisect.bisect_left(buckets, value)] += 1
+        histogram[2] += value
+
+    def lap(self, stage: str, started: float) -> float:
+        """将自 `started` 以来的耗时记入 `stage`，并返回下一阶段的起始时间。"""
+        now = time.perf_counter()
+        self.observe("stage_seconds", stage, now - started)
+        return now
+
+    def snapshot(self, counters: Dict[str, int], gauges: Dict[str, int]) -> Dict:
+        """计数器、指标值以及累计的直方图分桶，键为 `name` 或 `name.label`。"""
+        histograms = {}
+        for (name, label), (buckets, counts, total) in sorted(self._histograms.items()):
+            cumulative: Dict[str, int] = {}
+            running = 0
+            for bound, count in zip((*buckets, "+Inf"), counts):
+                running += count
+                cumulative[str(bound)] = running
+            histograms[f"{name}.{label}" if label else name] = {"count": running, "sum": round(total, 6), "buckets": cumulative}
+        return {"counters": {**self.counters, **counters}, "gauges": gauges, "histograms": histograms}
+
+    @staticmethod
+    def to_prometheus(snapshot: Dict, namespace: str = "time_awareness") -> str:
+        """将快照渲染为 Prometheus 文本格式，直方图的标签导出为 `stage`。"""
+        lines: List[str] = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {namespace}_{name}_total counter", f"{namespace}_{name}_total {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {namespace}_{name} gauge", f"{namespace}_{name} {value}"]
+        declared = set()
+        for key, histogram in snapshot["histograms"].items():
+            name, _, label = key.partition(".")
+            metric = f"{namespace}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            labels = f'stage="{label}",' if label else ""
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {count}')
+            labels = f'{{stage="{label}"}}' if label else ""
+            lines += [f"{metric}_sum{labels} {histogram['sum']}", f"{metric}_count{labels} {histogram['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        self.counters.clear()
+        self._histograms.clear()
+
+
+class _ChatDocumentReducer:
+    """根据 ijson 事件构建精简的对话文档，只保留 Filter 需要的内容。
+
+    每条消息保留 role、timestamp 和 parentId，用户消息还保留文本，另外保留 `currentId` 和 `updated_at`。
+    其余内容（图片、文件、助手输出）在流经时即被丢弃。
+    """
+
+    def __init__(self):
+        self._messages: Dict[str, Dict] = {}
+        self._history: Dict[str, Any] = {"messages": self._messages, "currentId": None}
+        self.document: Dict[str, Any] = {"updated_at": None, "chat": {"history": self._history}}
+        self._message: Optional[Dict] = None
+        self._part: Optional[Dict] = None
+        self._paths = ("",) * 8
+
+    def feed(self, events: List[Tuple[str, str, Any]]) -> None:
+        messages, history, document = self._messages, self._history, self.document
+        message, part = self._message, self._part
+        base, role_p, timestamp_p, parent_p, content_p, item_p, item_type_p, item_text_p = self._paths
+        for prefix, event, value in events:
+            if message is not None:
+                if prefix == base:
+                    if event in ("start_map", "map_key"): continue
+                    if message.get("role") != "user": message.pop("content", None)
+                    message = None
+                elif prefix == role_p: message["role"] = value
+                elif prefix == timestamp_p: message["timestamp"] = value
+                elif prefix == parent_p: message["parentId"] = value
+                elif prefix == content_p:
+                    if event == "string": message["content"] = value
+                    elif event == "start_array": message["content"] = []
+                elif prefix == item_p:
+                    if event == "start_map": part = {}
+                    elif event == "end_map" and part is not None:
+                        if part.get("type") == "text" and isinstance(message.get("content"), list): message["content"].append(part)
+                        part = None
+                elif part is not None and prefix == item_type_p: part["type"] = value
+                elif part is not None and prefix == item_text_p: part["text"] = value
+                continue
+
+            if prefix == "chat.history.messages" and event == "map_key":
+                message = messages[value] = {}
+                base = f"chat.history.messages.{value}"
+                role_p, timestamp_p, parent_p, content_p = f"{base}.role", f"{base}.timestamp", f"{base}.parentId", f"{base}.content"
+                item_p = f"{content_p}.item"
+                item_type_p, item_text_p = f"{item_p}.type", f"{item_p}.text"
+            elif prefix == "chat.history.currentId":
+                history["currentId"] = value
+            elif prefix == "updated_at":
+                document["updated_at"] = value
+        self._message, self._part = message, part
+        self._paths = (base, role_p, timestamp_p, parent_p, content_p, item_p, item_type_p, item_text_p)
+
+
+class _ChatDocumentParser:
+    """将对话文档逐块交给 ijson 解析，并送入 `_ChatDocumentReducer`。"""
+
+    def __init__(self):
+        self._reducer = _ChatDocumentReducer()
+        self._events = ijson.sendable_list()
+        self._parser = ijson.parse_coro(self._events, use_float=True)
+
+    def send(self, chunk: bytes) -> None:
+        self._parser.send(chunk)
+        self._reducer.feed(self._events)
+        del self._events[:]
+
+    def close(self) -> Dict:
+        self._parser.close()
+        self._reducer.feed(self._events)
+        return self._reducer.document
+
+
+async def _stream_chat_document(chunks: AsyncIterator[bytes], offload: Optional[Callable] = None) -> Dict:
+    """在分块到达时精简对话文档，完整的 JSON 不会被载入内存。
+
+    传入 `offload` 时，每个分块在工作线程中解析，同时下载下一个分块，因此最多只有一个已接收的分块在等待工作线程。
+    """
+    parser = _ChatDocumentParser()
+    if offload is None:
+        async for chunk in chunks: parser.send(chunk)
+        return parser.close()
+    parsing = None
+    try:
+        async for chunk in chunks:
+            if parsing is not None: await parsing
+            parsing = asyncio.ensure_future(offload(parser.send, chunk))
+        if parsing is not None: await parsing
+    except BaseException:
+        # 下载失败后不会再读取解析器，因此可以放弃仍在工作线程中的分块
+        if parsing is not None: parsing.cancel()
+        raise
+    return await offload(parser.close)
+
+
+class _MissingAuthToken(Exception):
+    """需要通过 HTTP 获取聊天历史但请求中没有 JWT 时抛出。"""
+
+
+class _CircuitOpen(Exception):
+    """历史熔断器处于打开状态时代替获取操作抛出。"""
+
+
+class _CircuitBreaker:
+    """连续 `threshold` 次调用失败或过慢后打开，在冷却时间结束前拒绝调用。"""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if time.monotonic() < self.open_until:
+            self.rejected += 1
+            return False
+        return True
+
+    def record(self, ok: bool, threshold: int, cooldown: float) -> None:
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        # 冷却结束后失败计数仍会保留，因此一次失败的试探调用就会重新打开熔断器
+        if threshold > 0 and self.failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """获取失败是否说明历史后端不健康：传输错误、超时和 5xx 响应。
+
+    4xx（对话已删除，或后端从未保存过的临时对话）是健康后端给出的及时应答。
+    """
+    if isinstance(error, (asyncio.TimeoutError, asyncio.CancelledError)): return True
+    if httpx is None: return False
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class _SingleFlight:
+    """将相同键的并发调用合并为一个进行中的任务，每个调用方都会得到其结果或错误。"""
+
+    def __init__(self):
+        self._calls: Dict[Any, List] = {}
+        self.coalesced = 0
+
+    async def run(self, key: Any, factory: Callable) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = [asyncio.ensure_future(factory()), 0]
+            call[0].add_done_callback(lambda task, key=key, call=call: self._finish(key, call, task))
+        else:
+            self.coalesced += 1
+        call[1] += 1
+        try:
+            # shield() keeps one caller's cancellation from cancelling the shared task for the others
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                # 立即注销，避免在取消生效前到达的调用方拿到已被取消的任务
+                if self._calls.get(key) is call: del self._calls[key]
+                call[0].cancel()
+
+    def _finish(self, key: Any, call: List, task: "asyncio.Future") -> None:
+        if self._calls.get(key) is call: del self._calls[key]
+        if not task.cancelled(): task.exception()
+
+    def cancel_all(self) -> None:
+        for task, _ in list(self._calls.values()): task.cancel()
+
+
+class _HistoryProvider:
+    """加载对话文档。`fetch` 返回 `(data, etag)`（自 `etag` 以来未变化时 `data` 为 None），无法获取该对话时返回 None。
+
+    等待远程响应的提供方会在响应开始到达时调用 `on_first_byte`。
+    """
+
+    name = "base"
+    bytes_read = 0
+
+    async def fetch(
+        self, chat_id: str, user_id: Optional[str], jwt_token: Optional[str], etag: Optional[str], on_first_byte: Optional[Callable[[], None]] = None
+    ) -> Optional[Tuple[Optional[Dict], Optional[str]]]:
+        raise NotImplementedError
+
+
+class _HttpHistoryProvider(_HistoryProvider):
+    """通过 Open WebUI REST API（`/api/v1/chats/{chat_id}`）读取对话。"""
+
+    name = "http"
+    # 分块足够大，交给工作线程的开销相对解析本身很小
+    _OFFLOAD_CHUNK_BYTES = 65536
+
+    def __init__(self, get_client: Callable, streaming_enabled: Callable[[], bool], offload_min_bytes: Callable[[], int], offload: Callable):
+        self._get_client = get_client
+        self._streaming_enabled = streaming_enabled
+        self._offload_min_bytes = offload_min_bytes
+        self._offload = offload
+
+    async def fetch(self, chat_id, user_id, jwt_token, etag, on_first_byte=None):
+        headers = {"Authorization": f"Bearer {jwt_token}"}
+        if etag: headers["If-None-Match"] = etag
+        client = await self._get_client()
+        async with client.stream("GET", f"/api/v1/chats/{chat_id}", headers=headers) as response:
+            if on_first_byte is not None: on_first_byte()
+            if response.status_code == 304: return None, etag
+            response.raise_for_status()
+            threshold = self._offload_min_bytes()
+            try:
+                if ijson is None or not self._streaming_enabled():
+                    await response.aread()
+                    if threshold > 0 and len(response.content) >= threshold:
+                        return await self._offload(response.json), response.headers.get("etag")
+                    return response.json(), response.headers.get("etag")
+                if threshold > 0 and int(response.headers.get("content-length") or 0) >= threshold:
+                    return await _stream_chat_document(response.aiter_bytes(self._OFFLOAD_CHUNK_BYTES), self._offload), response.headers.get("etag")
+                return await _stream_chat_document(response.aiter_bytes()), response.headers.get("etag")
+            finally:
+                self.bytes_read += response.num_bytes_downloaded
+
+
+class _SqliteHistoryProvider(_HistoryProvider):
+    """直接从 Open WebUI 的 SQLite 数据库读取 `chat.history`，绕过 HTTP 回环请求。"""
+
+    name = "sqlite"
+    _ETAG_PREFIX = "sqlite:"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def default_path() -> str:
+        database_url = os.environ.get("DATABASE_URL", "")
+        if database_url.startswith("sqlite:///"):
+            return database_url[len("sqlite:///"):]
+        return os.path.join(os.environ.get("DATA_DIR", "data"), "webui.db")
+
+    def _read(
+        self, chat_id: str, user_id: str, known_updated_at: Optional[str]
+    ) -> Optional[Tuple[Any, Optional[Dict], int]]:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                "SELECT updated_at, CASE WHEN CAST(updated_at AS TEXT) = ? THEN NULL ELSE json_extract(chat, '$.history') END FROM chat WHERE id = ? AND user_id = ?",
+                (known_updated_at, chat_id, user_id),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None: return None
+        updated_at, history_json = row
+        if history_json is None: return updated_at, None, 0
+        return updated_at, json.loads(history_json), len(history_json)
+
+    async def fetch(self, chat_id, user_id, jwt_token, etag, on_first_byte=None):
+        if not user_id or not os.path.exists(self.path): return None
+        known_updated_at = etag[len(self._ETAG_PREFIX):] if etag and etag.startswith(self._ETAG_PREFIX) else None
+        row = await asyncio.to_thread(self._read, chat_id, user_id, known_updated_at)
+        if row is None: return None
+        updated_at, history, size = row
+        new_etag = f"{self._ETAG_PREFIX}{updated_at}"
+        if history is None: return None, new_etag
+        self.bytes_read += size
+        return {"id": chat_id, "updated_at": updated_at, "chat": {"history": history}}, new_etag
+
+
+# 英文版与中文版共用的语言表，两个版本只在 `_LOCALE` 上不同
+_LOCALE = "zh"
+_WEEKDAY_NAMES = {
+    "en": ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"),
+    "zh": ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"),
+}
+_DATE_PATTERNS = {"ISO": "{0:04d}-{1:02d}-{2:02d}", "DMY_SLASH": "{2:02d}/{1:02d}/{0:04d}", "MDY_SLASH": "{1:02d}/{2:02d}/{0:04d}", "DMY_DOT": "{2:02d}.{1:02d}.{0:04d}"}
+
+
+class _TimeFormatter:
+    """为某个 (时区, date_format, 语言) 组合格式化时间前缀。完整日期部分按自然日缓存。"""
+
+    __slots__ = ("tz", "_date_pattern", "_weekdays", "_day_heads")
+    _MAX_DAYS = 4096
+
+    def __init__(self, tz: datetime.tzinfo, date_format: str, locale: str):
+        self.tz = tz
+        self._date_pattern = _DATE_PATTERNS.get(date_format, _DATE_PATTERNS["ISO"])
+        self._weekdays = _WEEKDAY_NAMES.get(locale, _WEEKDAY_NAMES["en"])
+        self._day_heads: Dict[datetime.date, str] = {}
+
+    def localize(self, timestamps: List[Optional[float]]) -> List[Optional[datetime.datetime]]:
+        tz = self.tz
+        fromtimestamp = datetime.datetime.fromtimestamp
+        return [fromtimestamp(timestamp, tz) if timestamp is not None else None for timestamp in timestamps]
+
+    def prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
+        time_str = f"{dt_object.hour:02d}:{dt_object.minute:02d}:{dt_object.second:02d}"
+        if not is_full_format: return f"[{time_str}]"
+        day = dt_object.date()
+        head = self._day_heads.get(day)
+        if head is None:
+            if len(self._day_heads) >= self._MAX_DAYS: self._day_heads.clear()
+            head = self._day_heads[day] = f"[{self._date_pattern.format(day.year, day.month, day.day)}, {self._weekdays[day.weekday()]}, "
+        return f"{head}{time_str}]"
+
+
+def _format_offset(seconds: float) -> str:
+    """紧凑的相对偏移，例如 "[+45s]"、"[+3m]" 或 "[+2h5m]"。"""
+    seconds = int(seconds)
+    if seconds < 60: return f"[+{seconds}s]"
+    hours, minutes = divmod(seconds // 60, 60)
+    if not hours: return f"[+{minutes}m]"
+    return f"[+{hours}h{minutes}m]" if minutes else f"[+{hours}h]"
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略的 token 数（约每 4 个字符一个 token），足以用于前缀预算。"""
+    return (len(text) + 3) // 4
+
+
+_FIRST_NON_SPACE = re.compile(r"\S")
+
+
+def _content_digest(content: Union[str, list, None]) -> bytes:
+    """消息文本的 16 字节摘要。多段内容逐段计算，无需先拼接。"""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(content, str):
+        digest.update(content.encode("utf-8", "surrogatepass"))
+    elif isinstance(content, list):
+        first = True
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                if not first: digest.update(b"\n")
+                digest.update((part.get("text") or "").encode("utf-8", "surrogatepass"))
+                first = False
+    return digest.digest()
+
+
+def _digest_user_messages(messages: List[dict]) -> Tuple[Dict[int, bytes], set, Dict[int, bytes]]:
+    """按下标返回用户消息的摘要、已经以 "[" 开头的消息下标，以及每条用户消息的分支指纹。
+
+    指纹涵盖该消息及其之前的所有用户和助手消息（请求中带有 id 时也包括 id），因此经由编辑后的分支到达的相同文本会得到不同的指纹。
+    """
+    digests: Dict[int, bytes] = {}
+    bracketed = set()
+    fingerprints: Dict[int, bytes] = {}
+    chain = b""
+    for i, message in enumerate(messages):
+        role = message.get("role")
+        if role != "user" and role != "assistant": continue
+        content = message.get("content")
+        digest = _content_digest(content)
+        chain = hashlib.blake2b(chain + role.encode() + digest + str(message.get("id") or "").encode(), digest_size=16).digest()
+        if role == "user":
+            digests[i] = digest
+            fingerprints[i] = chain
+            if _content_starts_with_bracket(content): bracketed.add(i)
+    return digests, bracketed, fingerprints
+
+
+def _content_starts_with_bracket(content: Union[str, list, None]) -> bool:
+    if isinstance(content, str):
+        match = _FIRST_NON_SPACE.search(content)
+        return match is not None and match.group() == "["
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                match = _FIRST_NON_SPACE.search(part.get("text") or "")
+                if match is not None: return match.group() == "["
+    return False
+
+
+class _TimestampIndex:
+    """将内容摘要映射到按时间排序的时间戳。重复内容的每次取出都是 O(1)。"""
+
+    __slots__ = ("_slots",)
+    # 表示不存在的槽位，因为消息的时间戳本身可能为 None
+    _MISSING = object()
+
+    def __init__(self, entries=()):
+        # A digest seen once maps straight to its timestamp; only repeated texts pay for a deque
+        self._slots: Dict[bytes, Any] = {}
+        for timestamp, digest in sorted(entries, key=lambda item: item[0] or 0):
+            self.add(digest, timestamp)
+
+    def add(self, digest: bytes, timestamp: Optional[float]) -> None:
+        slot = self._slots.get(digest, self._MISSING)
+        if slot is self._MISSING:
+            self._slots[digest] = timestamp
+        elif isinstance(slot, deque):
+            slot.append(timestamp)
+        else:
+            self._slots[digest] = deque((slot, timestamp))
+
+    def pop(self, digest: bytes) -> Optional[float]:
+        slot = self._slots.get(digest, self._MISSING)
+        if slot is self._MISSING: return None
+        if not isinstance(slot, deque):
+            del self._slots[digest]
+            return slot
+        timestamp = slot.popleft()
+        if not slot: del self._slots[digest]
+        return timestamp
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class _TimestampLedger:
+    """记录 Filter 已注入时间戳的 SQLite 台账，以 (用户, chat_id, 分支指纹) 为键。
+
+    WAL 模式的文件由本机所有工作进程共用，一个进程注入的时间戳所有进程都能查到。
+
+    同一指纹再次以不同的时间记录时，说明有两条文本和历史都相同的消息（编辑为相同文本的消息，或为重新生成回复而再次发送的消息）。
+    该记录随即被标记为有歧义，`lookup` 将其返回为 None，由调用方改从聊天历史中确定。
+    """
+
+    # 同一指纹相隔不超过该秒数的记录视为同一条消息（例如多模型同时回答）
+    SAME_MESSAGE_SECONDS = 5.0
+    _SCHEMA_VERSION = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._last_compaction = 0.0
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(os.environ.get("DATA_DIR", "data"), "time_awareness_ledger.db")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self._SCHEMA_VERSION:
+                # 第一版的记录以文本出现次序为键，无法区分分支
+                conn.execute("DROP TABLE IF EXISTS stamps")
+                conn.execute(f"PRAGMA user_version = {self._SCHEMA_VERSION}")
+            conn.execute("CREATE TABLE IF NOT EXISTS stamps (user_id TEXT NOT NULL, chat_id TEXT NOT NULL, fingerprint BLOB NOT NULL, timestamp REAL NOT NULL, ambiguous INTEGER NOT NULL DEFAULT 0, recorded_at REAL NOT NULL)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS stamps_key ON stamps (user_id, chat_id, fingerprint)")
+            conn.execute("CREATE INDEX IF NOT EXISTS stamps_recorded_at ON stamps (recorded_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def lookup(self, user_id: str, chat_id: str) -> Dict[bytes, Optional[float]]:
+        with self._lock:
+            rows = self._connect().execute("SELECT fingerprint, timestamp, ambiguous FROM stamps WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)).fetchall()
+        return {fingerprint: None if ambiguous else timestamp for fingerprint, timestamp, ambiguous in rows}
+
+    @classmethod
+    def should_record(cls, known: Dict[bytes, Optional[float]], fingerprint: bytes, timestamp: float) -> bool:
+        """`timestamp` 是否需要记录：其指纹不在 `known`（`lookup` 的结果）中，或已记录的时间与之明显不同。"""
+        if fingerprint not in known: return True
+        recorded = known[fingerprint]
+        return recorded is not None and abs(recorded - timestamp) > cls.SAME_MESSAGE_SECONDS
+
+    def record(self, user_id: str, chat_id: str, entries: List[Tuple[bytes, float]]) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT INTO stamps (user_id, chat_id, fingerprint, timestamp, recorded_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, chat_id, fingerprint) DO UPDATE SET ambiguous = 1, recorded_at = excluded.recorded_at WHERE abs(stamps.timestamp - excluded.timestamp) > ?",
+                [(user_id, chat_id, fp, ts, now, self.SAME_MESSAGE_SECONDS) for fp, ts in entries],
+            )
+            conn.commit()
+
+    def compact(self, retention_days: float, max_entries: int, interval: float = 3600.0) -> int:
+        """删除超出保留期限的记录，并裁剪超过 `max_entries` 的最旧记录。每 `interval` 秒最多执行一次。"""
+        now = time.time()
+        if now - self._last_compaction < interval: return 0
+        self._last_compaction = now
+        with self._lock:
+            conn = self._connect()
+            removed = 0
+            if retention_days > 0:
+                removed += conn.execute("DELETE FROM stamps WHERE recorded_at < ?", (now - retention_days * 86400,)).rowcount
+            if max_entries > 0:
+                removed += conn.execute("DELETE FROM stamps WHERE rowid IN (SELECT rowid FROM stamps ORDER BY recorded_at DESC LIMIT -1 OFFSET ?)", (max_entries,)).rowcount
+            conn.commit()
+            if removed: conn.execute("PRAGMA incremental_vacuum")
+        return removed
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _RedisTimestampLedger(_TimestampLedger):
+    """位于兼容 Redis 的服务器中的时间戳台账，由分布在多台主机上的工作进程共用。调用会阻塞，因此在工作线程中执行。
+
+    每个对话是一个从指纹到时间戳的哈希，空值表示该指纹有歧义。记录以一个服务端脚本执行，因此两个进程同时记录同一指纹时不会丢失歧义标记。
+    对话在最后一次记录 `retention_days` 天后过期；总容量由服务器的 `maxmemory` 策略限制。
+    """
+
+    _KEY_PREFIX = "time_awareness:ledger:"
+    # KEYS[1]: 对话的哈希；ARGV：TTL 秒数（0 表示不过期）、SAME_MESSAGE_SECONDS，然后是成对的指纹和时间戳
+    _RECORD_SCRIPT = """
+local same = tonumber(ARGV[2])
+for i = 3, #ARGV, 2 do
+    local recorded = redis.call('HGET', KEYS[1], ARGV[i])
+    if not recorded then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    elseif recorded ~= '' and math.abs(tonumber(recorded) - tonumber(ARGV[i + 1])) > same then
+        redis.call('HSET', KEYS[1], ARGV[i], '')
+    end
+end
+if tonumber(ARGV[1]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+"""
+
+    def __init__(self, url: str, retention_days: float = 0.0):
+        self.url = url
+        self.retention_days = retention_days
+        self._client = None
+        self._record_script = None
+
+    def _connect(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url, socket_timeout=2.0, socket_connect_timeout=2.0)
+            self._record_script = self._client.register_script(self._RECORD_SCRIPT)
+        return self._client
+
+    def _key(self, user_id: str, chat_id: str) -> str:
+        return f"{self._KEY_PREFIX}{user_id}:{chat_id}"
+
+    def lookup(self, user_id, chat_id):
+        rows = self._connect().hgetall(self._key(user_id, chat_id))
+        return {fingerprint: float(timestamp) if timestamp else None for fingerprint, timestamp in rows.items()}
+
+    def record(self, user_id, chat_id, entries):
+        self._connect()
+        args: List[Any] = [int(self.retention_days * 86400), self.SAME_MESSAGE_SECONDS]
+        for fingerprint, timestamp in entries: args += [fingerprint, repr(float(timestamp))]
+        self._record_script(keys=[self._key(user_id, chat_id)], args=args)
+
+    def compact(self, retention_days, max_entries, interval=3600.0):
+        """无需处理：对话通过键的 TTL 过期，容量由服务器的 `maxmemory` 策略限制。"""
+        return 0
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
 class Filter:
     class Valves(BaseModel):
         api_base_url: str = Field(
@@ -44,15 +739,129 @@ class Filter:
         debug_print_request: bool = Field(
             default=False, description="在日志中打印详细的调试信息和性能数据。"
         )
+        http_max_connections: int = Field(
+            default=20, description="共享 HTTP 客户端与后端之间的最大并发连接数。"
+        )
+        http_max_keepalive_connections: int = Field(
+            default=10, description="连接池中保留的最大空闲长连接数。"
+        )
+        http_keepalive_expiry: float = Field(
+            default=30.0, description="空闲长连接在连接池中保留的秒数，超时后关闭。"
+        )
+        http_connect_timeout: float = Field(
+            default=5.0, description="与后端建立连接的超时时间（秒）。"
+        )
+        http_read_timeout: float = Field(
+            default=10.0, description="读取聊天历史响应的超时时间（秒）。"
+        )
+        streaming_parse: bool = Field(
+            default=True,
+            description="流式读取聊天历史响应，只保留所需字段，不再将图片和助手输出载入内存。需要安装 `ijson`，未安装时读取完整 JSON。",
+        )
+        history_provider: str = Field(
+            default="http",
+            description='聊天历史的读取来源。"http" 调用 Open WebUI API；"sqlite" 直接读取 Open WebUI 的 SQLite 数据库，无法读取时回退到 "http"。',
+        )
+        database_path: str = Field(
+            default="",
+            description='"sqlite" 读取方式使用的 Open WebUI SQLite 数据库（webui.db）路径。留空则根据 DATABASE_URL 或 DATA_DIR 推断。',
+        )
+        ledger_enabled: bool = Field(
+            default=False,
+            description="将每次注入的时间戳记录到所有工作进程共用的台账中（见 `ledger_backend`），后续轮次无论由哪个进程处理都直接查询台账，无需获取聊天历史。记录以消息及其之前的全部内容为键，因此编辑产生的分支不会共用记录。",
+        )
+        ledger_backend: str = Field(
+            default="sqlite",
+            description='台账的存储位置。"sqlite" 使用 `ledger_path` 指定的本机文件，由同一主机上的工作进程共用；"redis" 使用 `ledger_redis_url` 指定的服务器，可跨主机共用。',
+        )
+        ledger_path: str = Field(
+            default="", description="\"sqlite\" 台账的数据库路径。留空则保存为 DATA_DIR 下的 time_awareness_ledger.db。"
+        )
+        ledger_redis_url: str = Field(
+            default="redis://localhost:6379/0", description="\"redis\" 台账的连接地址（需要 `pip install redis`）。"
+        )
+        ledger_retention_days: float = Field(
+            default=90.0, description="超过该天数的台账记录会被删除。0 表示永久保留。"
+        )
+        ledger_max_entries: int = Field(
+            default=1000000, description="台账最多保留的记录数，超出时优先删除最旧的记录。0 表示不限制。"
+        )
+        incremental_injection: bool = Field(
+            default=False,
+            description="记住每个对话中已确定时间戳的部分，后续轮次只处理新增的消息。只有其后的消息未变化且消息 id 仍与聊天历史一致时才复用。请求不带消息 id 且未启用台账时，每轮仍需获取聊天历史来核对 id。",
+        )
+        history_latency_budget: float = Field(
+            default=3.0,
+            description="每次请求等待聊天历史的最长秒数，超时后只为当前消息添加时间。获取失败时同样处理。0 表示不限制。",
+        )
+        circuit_breaker_failures: int = Field(
+            default=3, description="连续多少次获取历史失败或过慢后暂停获取历史。只有连接错误、超时和 5xx 响应算作失败。0 表示禁用熔断器。"
+        )
+        circuit_breaker_slow_seconds: float = Field(
+            default=2.0, description="获取历史时响应超过该秒数仍未开始到达即视为一次失败。"
+        )
+        circuit_breaker_cooldown_seconds: float = Field(
+            default=30.0, description="熔断器打开后暂停获取历史的秒数。"
+        )
+        error_notification_interval: float = Field(
+            default=60.0, description="向同一用户发送两次错误通知之间的最短间隔（秒）。0 表示每次都通知。"
+        )
+        offload_min_messages: int = Field(
+            default=2000, description="消息数不少于此值的对话会在工作线程中解析和建立索引，避免大型历史阻塞其他请求所在的事件循环。0 表示始终在事件循环中处理。"
+        )
+        offload_min_bytes: int = Field(
+            default=1000000, description="不少于此字节数的聊天历史响应会在工作线程中解码，而不是在事件循环中解码。开启 streaming_parse 时每个分块到达后即在工作线程中解析，否则先完整下载。0 表示不转移。"
+        )
+        metrics_enabled: bool = Field(
+            default=False, description="收集各阶段耗时、计数器和对话规模直方图。与 `debug_print_request` 无关，关闭时几乎没有开销。"
+        )
+        metrics_log_interval: float = Field(
+            default=300.0, description="两次将指标快照写入日志之间的秒数。0 表示不写日志（仍可通过 `metrics_snapshot()` 读取）。"
+        )
+        metrics_log_format: str = Field(
+            default="json", description='日志中指标快照的格式："json"（一行结构化日志）或 "prometheus"（Prometheus 文本格式）。'
+        )
+        prefix_compaction: str = Field(
+            default="off",
+            description='减少历史消息时间前缀占用的 token。"off" 为每条用户消息添加时间；"last_n" 只为最后 `prefix_compaction_last_n` 条历史消息添加；"minute_runs" 在同一分钟内发送的连续消息中只为第一条添加；"relative" 在每天的完整日期之后改用相对上一条消息的偏移（如 "[+3m]"）。"off" 以外的模式中，当前消息始终带有完整日期。',
+        )
+        prefix_compaction_last_n: int = Field(
+            default=20, description='"last_n" 模式下保留时间前缀的历史用户消息条数。'
+        )
+        prefix_token_budget: int = Field(
+            default=0, description="历史消息时间前缀最多占用的估算 token 数（约每 4 个字符一个 token），超出时优先去掉最早的前缀。0 表示不限制。"
+        )
+        history_cache_enabled: bool = Field(
+            default=True, description="在内存中缓存解析后的聊天历史。需要历史的每一轮仍会向后端重新校验，但无需重新解析已知的消息；后端确认对话未变化时也无需重新下载。"
+        )
+        history_cache_ttl_seconds: float = Field(
+            default=600.0, description="缓存的聊天历史的有效期（秒），过期后重新获取。0 表示永不过期。"
+        )
+        history_cache_max_chats: int = Field(
+            default=256, description="历史缓存中最多保留的对话数量。"
+        )
+        history_cache_max_messages: int = Field(
+            default=50000, description="历史缓存中所有对话合计最多保留的用户消息数量。"
+        )
 
     def __init__(self):
         self.valves = self.Valves()
         self.toggle = True
         self.icon = "data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHdpZHRoPSIyNCIgaGVpZ2h0PSIyNCIgdmlld0JveD0iMCAwIDI0IDI0IiBmaWxsPSJub25lIiBzdHJva2U9ImN1cnJlbnRDb2xvciIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiIGNsYXNzPSJsdWNpZGUgbHVjaWRlLWNsb2NrIj48Y2lyY2xlIGN4PSIxMiIgY3k9IjEyIiByPSIxMCIvPjxwb2x5bGluZSBwb2ludHM9IjEyIDYgMTIgMTIgMTYgMTQiLz48L3N2Zz4="
-        self.weekday_map = {
-            0: "星期一", 1: "星期二", 2: "星期三", 3: "星期四",
-            4: "星期五", 5: "星期六", 6: "星期日",
-        }
+        self._formatters: Dict[Tuple[str, str], _TimeFormatter] = {}
+        self._http_client = None
+        self._http_client_config: Optional[tuple] = None
+        self._history_cache = _HistoryCache()
+        self._history_flights = _SingleFlight()
+        self._history_breaker = _CircuitBreaker()
+        self._last_notifications = _LruCache()
+        self._metrics = _Metrics()
+        self._http_provider = _HttpHistoryProvider(self._get_http_client, lambda: self.valves.streaming_parse, lambda: self.valves.offload_min_bytes, self._offload)
+        self._sqlite_provider: Optional[_SqliteHistoryProvider] = None
+        self._ledger: Optional[_TimestampLedger] = None
+        self._ledger_config: Optional[tuple] = None
+        self._injection_states = _LruCache()
+        self._offload_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
         if not httpx:
             LOGGER.error("`httpx` 库未安装。时间感知 Filter 将无法工作。请运行 `pip install httpx`。")
 
@@ -69,45 +878,350 @@ class Filter:
             LOGGER.error(f"提取JWT token时出错: {e}")
             return None
 
+    def _http_client_settings(self) -> tuple:
+        v = self.valves
+        return (
+            v.api_base_url.strip("/"),
+            v.http_max_connections,
+            v.http_max_keepalive_connections,
+            v.http_keepalive_expiry,
+            v.http_connect_timeout,
+            v.http_read_timeout,
+        )
+
+    async def _get_http_client(self):
+        """返回长期复用的连接池客户端，相关 Valves 变化时重建。"""
+        settings = self._http_client_settings()
+        if (
+            self._http_client is not None
+            and not self._http_client.is_closed
+            and settings == self._http_client_config
+        ):
+            return self._http_client
+
+        old_client = self._http_client
+        base_url, max_conn, max_keepalive, keepalive_expiry, connect_timeout, read_timeout = settings
+        self._http_client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=max_conn,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._http_client_config = settings
+        if old_client is not None and not old_client.is_closed:
+            if self.valves.debug_print_request: LOGGER.info("HTTP 客户端配置已变更，重建连接池。")
+            await old_client.aclose()
+        return self._http_client
+
+    async def close(self) -> None:
+        """关闭连接池客户端，可重复调用。"""
+        self._history_flights.cancel_all()
+        self._history_cache.clear()
+        self._injection_states.clear()
+        self._last_notifications.clear()
+        if self._ledger is not None:
+            self._ledger.close()
+            self._ledger, self._ledger_config = None, None
+        if self._offload_executor is not None:
+            self._offload_executor.shutdown(wait=False)
+            self._offload_executor = None
+        client, self._http_client, self._http_client_config = self._http_client, None, None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+    def _get_direct_history_providers(self) -> List[_HistoryProvider]:
+        """根据 `history_provider` 返回在回退到 HTTP 之前尝试的进程内读取方式。"""
+        if self.valves.history_provider != "sqlite": return []
+        path = self.valves.database_path or _SqliteHistoryProvider.default_path()
+        if self._sqlite_provider is None or self._sqlite_provider.path != path:
+            self._sqlite_provider = _SqliteHistoryProvider(path)
+        return [self._sqlite_provider]
+
     async def _get_chat_history(
-        self, chat_id: str, jwt_token: str, event_emitter: Optional[Callable]
-    ) -> Optional[Dict]:
+        self,
+        chat_id: str,
+        jwt_token: Optional[str],
+        etag: Optional[str] = None,
+        user_id: Optional[str] = None,
+        on_first_byte: Optional[Callable[[], None]] = None,
+    ) -> Optional[Tuple[Optional[Dict], Optional[str]]]:
+        """获取对话文档。返回 `(data, etag)`，后端表明未变化时 `data` 为 None。失败时抛出异常。"""
+        for provider in self._get_direct_history_providers():
+            try:
+                result = await provider.fetch(chat_id, user_id, jwt_token, etag, on_first_byte)
+                if result is not None: return result
+                if self.valves.debug_print_request: LOGGER.info(f"读取方式 '{provider.name}' 中没有该对话的数据，回退到 HTTP。")
+            except Exception as e:
+                LOGGER.warning(f"读取方式 '{provider.name}' 失败，回退到 HTTP: {e}")
+
         if not httpx: return None
-        if not jwt_token:
-            LOGGER.error("认证令牌 (JWT) 为空，无法获取聊天历史。")
-            if event_emitter:
-                await event_emitter({"type": "notification", "data": {"type": "error", "content": "时间感知: 无法获取用户认证信息"}})
-            return None
+        if not jwt_token: raise _MissingAuthToken()
+        return await self._http_provider.fetch(chat_id, user_id, jwt_token, etag, on_first_byte)
 
-        api_url = f"{self.valves.api_base_url.strip('/')}/api/v1/chats/{chat_id}"
-        headers = {"Authorization": f"Bearer {jwt_token}"}
-        
+    def _parse_chat_history(self, chat_history_data: Dict, etag: Optional[str], previous: Optional[Dict] = None) -> Dict:
+        """将对话文档精简为 Filter 所需的用户消息时间戳。`updated_at` 未变化时直接复用 `previous`。"""
+        updated_at = chat_history_data.get("updated_at")
+        if previous is not None and updated_at is not None and updated_at == previous.get("updated_at"):
+            return {**previous, "etag": etag or previous.get("etag")}
+
+        messages: Dict[str, Tuple[Any, bytes]] = {}
+        parents: Dict[str, Optional[str]] = {}
+        history = chat_history_data.get("chat", {}).get("history", {})
+        history_messages = history.get("messages", {})
+        if isinstance(history_messages, dict):
+            for msg_id, msg_data in history_messages.items():
+                if not isinstance(msg_data, dict): continue
+                parents[msg_id] = msg_data.get("parentId")
+                if msg_data.get("role") != "user" or "timestamp" not in msg_data: continue
+                # 始终重新计算摘要：原地编辑会保留消息的 id 和时间戳
+                messages[msg_id] = (msg_data.get("timestamp"), _content_digest(msg_data.get("content")))
+
+        return {"messages": messages, "parents": parents, "current_id": history.get("currentId"), "updated_at": updated_at, "etag": etag}
+
+    def _should_offload(self, message_count: int) -> bool:
+        threshold = self.valves.offload_min_messages
+        return threshold > 0 and message_count >= threshold
+
+    async def _offload(self, func: Callable, *args) -> Any:
+        """在 Filter 专用的单个工作线程中运行 CPU 密集的任务。只用一个线程，避免转移出去的任务挤占事件循环所需的 GIL。"""
+        if self._offload_executor is None:
+            self._offload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="time-awareness")
+        return await asyncio.get_running_loop().run_in_executor(self._offload_executor, func, *args)
+
+    def _active_branch_user_ids(self, history: Dict) -> Optional[List[str]]:
+        """当前分支上的用户消息 id，从根节点到 `currentId`。对话没有可用的 `currentId` 时返回 None。"""
+        parents = history.get("parents")
+        node = history.get("current_id")
+        if not parents or node not in parents: return None
+        messages = history["messages"]
+        branch: List[str] = []
+        seen = set()
+        while node is not None and node not in seen:
+            seen.add(node)
+            if node in messages: branch.append(node)
+            node = parents.get(node)
+        branch.reverse()
+        return branch
+
+    def _build_timestamp_index(self, history: Dict, wanted: Counter, branch: Optional[List[str]], resolved: List[Optional[bytes]], skip: int = 0) -> _TimestampIndex:
+        """已确定的消息（`resolved`，按顺序排列的摘要，自带时间的消息为 None）取走各自的时间后，剩给 `wanted` 摘要的时间戳。
+
+        当前分支（`branch`，来自 `_active_branch_user_ids`）包含所有所需摘要时只索引该分支，否则索引对话中全部用户消息（按时间排序）。
+        分支的前 `skip` 条用户消息就是前 `skip` 条已确定的消息，不会被索引。
+        """
+        messages = history["messages"]
+        claimed = [digest for digest in resolved[skip:] if digest is not None]
+        if branch is not None:
+            counts = Counter(messages[msg_id][1] for msg_id in branch[skip:])
+            if all(counts[digest] >= count for digest, count in (wanted + Counter(claimed)).items()):
+                index = _TimestampIndex()
+                for msg_id in branch[skip:]:
+                    timestamp, digest = messages[msg_id]
+                    index.add(digest, timestamp)
+                for digest in claimed: index.pop(digest)
+                return index
+        index = _TimestampIndex(messages.values())
+        for digest in resolved:
+            if digest is not None: index.pop(digest)
+        return index
+
+    def _user_key(self, user: Optional[dict], jwt_token: Optional[str]) -> str:
+        user_id = user.get("id") if isinstance(user, dict) else None
+        if not user_id and jwt_token: user_id = hashlib.sha256(jwt_token.encode()).hexdigest()
+        return user_id or ""
+
+    def _history_cache_key(self, chat_id: str, user: Optional[dict], jwt_token: Optional[str]) -> Tuple[str, str]:
+        return (self._user_key(user, jwt_token), chat_id)
+
+    async def _load_chat_history(self, chat_id: str, user: Optional[dict], jwt_token: Optional[str], event_emitter: Optional[Callable]) -> Optional[Dict]:
+        """返回已解析的聊天历史，每次调用都会向后端重新校验。缓存的副本可在后端确认对话未变化时省去下载，并避免重新解析其中已有的消息。"""
+        v = self.valves
+        cache = self._history_cache
+        key = self._history_cache_key(chat_id, user, jwt_token)
+        # 缓存的副本从不直接使用：编辑或切换分支时消息文本可能完全不变，只有时间戳和 `currentId` 发生变化
+        cached = cache.get(key, v.history_cache_ttl_seconds) if v.history_cache_enabled else None
+        user_id = user.get("id") if isinstance(user, dict) else None
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(api_url, headers=headers)
-                response.raise_for_status()
-                return response.json()
+            # 同一对话和用户的并发 inlet（例如多模型同时回答）共享一次获取与解析
+            return await self._history_flights.run(key, lambda: self._refresh_chat_history(key, chat_id, user_id, jwt_token, cached))
+        except _CircuitOpen:
+            raise
+        except _MissingAuthToken:
+            LOGGER.error("认证令牌 (JWT) 为空，无法获取聊天历史。")
+            await self._notify_error(event_emitter, key[0], "时间感知: 无法获取用户认证信息")
         except Exception as e:
             LOGGER.error(f"获取或解析聊天历史时发生错误: {e}")
-            if event_emitter:
-                await event_emitter({"type": "notification", "data": {"type": "error", "content": "时间感知: 获取历史记录失败"}})
+            await self._notify_error(event_emitter, key[0], "时间感知: 获取历史记录失败")
         return None
 
-    def get_time_prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
-        time_str = dt_object.strftime("%H:%M:%S")
-        if is_full_format:
-            format_str = {"ISO": "%Y-%m-%d", "DMY_SLASH": "%d/%m/%Y", "MDY_SLASH": "%m/%d/%Y", "DMY_DOT": "%d.%m.%Y"}.get(self.valves.date_format, "%Y-%m-%d")
-            date_str = dt_object.strftime(format_str)
-            weekday_str = self.weekday_map[dt_object.weekday()]
-            return f"[{date_str}, {weekday_str}, {time_str}]"
+    async def _notify_error(self, event_emitter: Optional[Callable], user_key: str, content: str) -> None:
+        """发送错误通知，每个用户在 `error_notification_interval` 内最多通知一次。"""
+        if not event_emitter: return
+        interval = self.valves.error_notification_interval
+        now = time.monotonic()
+        last = self._last_notifications.get(user_key)
+        if interval > 0 and last is not None and now - last < interval: return
+        self._last_notifications.put(user_key, now, 1024)
+        await event_emitter({"type": "notification", "data": {"type": "error", "content": content}})
+
+    async def _refresh_chat_history(self, key: Tuple[str, str], chat_id: str, user_id: Optional[str], jwt_token: Optional[str], cached: Optional[Dict]) -> Optional[Dict]:
+        v = self.valves
+        cache = self._history_cache
+        breaker = self._history_breaker
+        if not breaker.allow(): raise _CircuitOpen()
+        metrics = self._metrics
+        metrics.counters["history_fetches"] += 1
+        started = time.monotonic()
+        first_byte: List[float] = []
+        try:
+            result = await self._get_chat_history(chat_id, jwt_token, etag=cached.get("etag") if cached else None, user_id=user_id, on_first_byte=lambda: first_byte.append(time.monotonic()))
+        except _MissingAuthToken:
+            raise
+        except BaseException as e:
+            # 所有等待方都超出延迟预算而导致的取消按超时计算
+            breaker.record(not _is_backend_failure(e), v.circuit_breaker_failures, v.circuit_breaker_cooldown_seconds)
+            metrics.counters["history_fetch_failures"] += 1
+            raise
+        elapsed = time.monotonic() - started
+        # 以首字节时间判断是否过慢，因此全速下载的大对话不算失败
+        latency = first_byte[0] - started if first_byte else elapsed
+        breaker.record(latency <= v.circuit_breaker_slow_seconds, v.circuit_breaker_failures, v.circuit_breaker_cooldown_seconds)
+        if v.metrics_enabled: metrics.observe("stage_seconds", "fetch", elapsed)
+        if result is None: return None
+        chat_history_data, etag = result
+        if chat_history_data is None:
+            cache.hits += 1
+            entry = cached
+        else:
+            cache.misses += 1
+            parse_started = time.perf_counter()
+            history_messages = chat_history_data.get("chat", {}).get("history", {}).get("messages")
+            if self._should_offload(len(history_messages) if isinstance(history_messages, dict) else 0):
+                entry = await self._offload(self._parse_chat_history, chat_history_data, etag, cached)
+            else:
+                entry = self._parse_chat_history(chat_history_data, etag, cached)
+            if v.metrics_enabled:
+                metrics.observe("stage_seconds", "parse", time.perf_counter() - parse_started)
+                metrics.observe("history_user_messages", "", len(entry["messages"]), _Metrics.SIZE_BUCKETS)
+        if v.history_cache_enabled:
+            cache.put(key, entry, v.history_cache_max_chats, v.history_cache_max_messages)
+        return entry
+
+    def _get_ledger(self) -> Optional[_TimestampLedger]:
+        v = self.valves
+        if not v.ledger_enabled: config = None
+        elif v.ledger_backend == "redis": config = ("redis", v.ledger_redis_url, v.ledger_retention_days)
+        else: config = ("sqlite", v.ledger_path or _TimestampLedger.default_path())
+        if config != self._ledger_config:
+            if self._ledger is not None: self._ledger.close()
+            self._ledger, self._ledger_config = None, config
+            if config is None: pass
+            elif config[0] == "sqlite": self._ledger = _TimestampLedger(config[1])
+            elif redis is None: LOGGER.error("未安装 `redis` 库，台账已停用。请运行 `pip install redis`。")
+            else: self._ledger = _RedisTimestampLedger(config[1], config[2])
+        return self._ledger
+
+    async def _record_in_ledger(self, ledger: _TimestampLedger, user_key: str, chat_id: str, entries: List[Tuple[bytes, float]]) -> None:
+        try:
+            await asyncio.to_thread(ledger.record, user_key, chat_id, entries)
+            removed = await asyncio.to_thread(ledger.compact, self.valves.ledger_retention_days, self.valves.ledger_max_entries)
+            if removed and self.valves.debug_print_request: LOGGER.info(f"台账整理删除了 {removed} 条记录。")
+        except Exception as e:
+            LOGGER.warning(f"写入时间戳台账失败: {e}")
+
+    def history_cache_stats(self) -> Dict[str, int]:
+        return {**self._history_cache.stats(), "coalesced": self._history_flights.coalesced, "circuit_rejected": self._history_breaker.rejected}
+
+    def metrics_snapshot(self) -> Dict:
+        """以字典形式返回当前指标。各阶段耗时和直方图只在开启 `metrics_enabled` 时记录。"""
+        cache = self._history_cache.stats()
+        bytes_read = self._http_provider.bytes_read + (self._sqlite_provider.bytes_read if self._sqlite_provider else 0)
+        counters = {
+            "history_cache_hits": cache["hits"], "history_cache_misses": cache["misses"], "history_cache_evictions": cache["evictions"],
+            "history_coalesced": self._history_flights.coalesced, "history_circuit_rejected": self._history_breaker.rejected, "history_bytes_read": bytes_read,
+        }
+        return self._metrics.snapshot(counters, {"history_cache_chats": cache["chats"], "history_cache_messages": cache["messages"]})
+
+    def metrics_prometheus(self) -> str:
+        return _Metrics.to_prometheus(self.metrics_snapshot())
+
+    def _log_metrics(self) -> None:
+        interval = self.valves.metrics_log_interval
+        now = time.monotonic()
+        if interval <= 0 or now - self._metrics.last_logged < interval: return
+        self._metrics.last_logged = now
+        if self.valves.metrics_log_format == "prometheus":
+            LOGGER.info(f"指标:\n{self.metrics_prometheus()}")
         else:
-            return f"[{time_str}]"
+            LOGGER.info(f"指标: {json.dumps(self.metrics_snapshot(), separators=(',', ':'))}")
 
-    def _get_text_from_content(self, content: Union[str, list, None]) -> str:
-        if isinstance(content, str): return content
-        if isinstance(content, list):
-            return "\n".join([p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text"])
-        return ""
+    def _get_formatter(self, timezone_name: str) -> _TimeFormatter:
+        """返回 (时区, date_format) 对应的缓存格式化器，时区无效时回退到 UTC。"""
+        key = (timezone_name, self.valves.date_format)
+        formatter = self._formatters.get(key)
+        if formatter is None:
+            try:
+                tz = zoneinfo.ZoneInfo(timezone_name)
+            except Exception as e:
+                LOGGER.error(f"时区 '{timezone_name}' 无效，将回退到 UTC。错误: {e}")
+                tz = zoneinfo.ZoneInfo("UTC")
+            if len(self._formatters) >= 64: self._formatters.clear()
+            formatter = self._formatters[key] = _TimeFormatter(tz, self.valves.date_format, _LOCALE)
+        return formatter
+
+    def get_time_prefix(self, dt_object: datetime.datetime, is_full_format: bool) -> str:
+        return self._get_formatter(getattr(dt_object.tzinfo, "key", "UTC")).prefix(dt_object, is_full_format)
+
+    def _render_prefixes(self, formatter: _TimeFormatter, stamped: List[Tuple[int, datetime.datetime]]) -> List[Tuple[int, str]]:
+        mode = self.valves.prefix_compaction
+        prefixes: List[Tuple[int, str]] = []
+        previous: Optional[datetime.datetime] = None
+        for i, dt in stamped:
+            if previous is None or dt.date() != previous.date():
+                prefixes.append((i, formatter.prefix(dt, True)))
+            elif mode == "minute_runs":
+                if (dt.hour, dt.minute) != (previous.hour, previous.minute): prefixes.append((i, formatter.prefix(dt, False)))
+            elif mode == "relative" and dt >= previous:
+                prefixes.append((i, _format_offset((dt - previous).total_seconds())))
+            else:
+                prefixes.append((i, formatter.prefix(dt, False)))
+            previous = dt
+        return prefixes
+
+    def _compact_prefixes(self, formatter: _TimeFormatter, stamped: List[Tuple[int, datetime.datetime]], current_index: int) -> List[Tuple[int, str]]:
+        """按 `prefix_compaction` 和 `prefix_token_budget` 生成前缀。`stamped` 按顺序列出 (消息下标, 时间)；当前消息始终使用完整前缀。"""
+        v = self.valves
+        past = [(i, dt) for i, dt in stamped if i != current_index]
+        if v.prefix_compaction == "last_n": past = past[-v.prefix_compaction_last_n:] if v.prefix_compaction_last_n > 0 else []
+        prefixes = self._render_prefixes(formatter, past)
+        budget = v.prefix_token_budget
+        if budget > 0:
+            # 保留预算内最新的前缀，再重新生成，使保留的最早一条消息成为当天的完整日期锚点
+            costs = {i: _estimate_tokens(prefix) for i, prefix in prefixes}
+            start = len(past)
+            spent = 0
+            while start > 0 and spent + costs.get(past[start - 1][0], 0) <= budget:
+                start -= 1
+                spent += costs.get(past[start][0], 0)
+            while True:
+                kept = self._render_prefixes(formatter, past[start:])
+                if start >= len(past) or sum(_estimate_tokens(prefix) for _, prefix in kept) <= budget: break
+                start += 1
+            prefixes = kept
+        current = [(i, formatter.prefix(dt, True)) for i, dt in stamped if i == current_index]
+        return prefixes + current
+
+    def _apply_time_prefix(self, message: dict, time_prefix: str) -> None:
+        content = message.get("content")
+        if isinstance(content, str): message["content"] = f"{time_prefix}\n{content}"
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    part["text"] = f"{time_prefix}\n{part.get('text', '')}"; return
+            content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
 
     async def inlet(
         self,
@@ -115,6 +1229,7 @@ class Filter:
         __metadata__: Optional[dict] = None,
         __event_emitter__: Optional[Callable] = None,
         __request__: Optional[object] = None,
+        __user__: Optional[dict] = None,
     ) -> dict:
         start_time = time.time()
         
@@ -122,6 +1237,8 @@ class Filter:
             if not __request__: LOGGER.warning("无法访问 __request__，跳过时间注入。")
             return body
 
+        metrics = self._metrics if self.valves.metrics_enabled else None
+        stage_started = started = time.perf_counter() if metrics else 0.0
         if self.valves.debug_print_request: LOGGER.info("--- 时间感知 Filter 开始运行 ---")
 
         messages_to_send = body.get("messages", [])
@@ -135,22 +1252,18 @@ class Filter:
                 user_timezone_str = tz_from_meta
             else:
                 LOGGER.warning("在元数据中未找到时区信息，将回退到 UTC。")
-        
-        try:
-            tz = zoneinfo.ZoneInfo(user_timezone_str)
-        except Exception as e:
-            LOGGER.error(f"时区 '{user_timezone_str}' 无效，将回退到 UTC。错误: {e}")
-            tz = zoneinfo.ZoneInfo("UTC")
+
+        formatter = self._get_formatter(user_timezone_str)
 
         # 如果是新对话，直接为当前消息添加时间戳
         chat_id = __metadata__.get("chat_id") if __metadata__ else None
         if not chat_id:
             if messages_to_send[-1].get("role") == "user":
-                time_prefix = self.get_time_prefix(datetime.datetime.now(tz), is_full_format=True)
+                time_prefix = formatter.prefix(datetime.datetime.now(formatter.tz), is_full_format=True)
                 last_message = messages_to_send[-1]
                 content = last_message.get("content")
                 
-                if self._get_text_from_content(content).strip().startswith("["): return body
+                if _content_starts_with_bracket(content): return body
                 
                 if isinstance(content, str):
                     last_message["content"] = f"{time_prefix}\n{content}"
@@ -158,62 +1271,165 @@ class Filter:
                     content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
             return body
 
-        # 对于已有对话，获取历史并注入时间
-        jwt_token = self._extract_jwt_from_request(__request__)
-        chat_history_data = await self._get_chat_history(chat_id, jwt_token, __event_emitter__)
-        if not chat_history_data:
-            LOGGER.warning("获取聊天历史失败，跳过时间注入。")
-            return body
-
-        content_to_timestamps_map = defaultdict(list)
-        history_messages = chat_history_data.get("chat", {}).get("history", {}).get("messages", {})
-        
-        if isinstance(history_messages, dict):
-            sorted_history = sorted(history_messages.values(), key=lambda msg: msg.get("timestamp", 0))
-            for msg_data in sorted_history:
-                if isinstance(msg_data, dict) and msg_data.get("role") == "user":
-                    text_content = self._get_text_from_content(msg_data.get("content"))
-                    if "timestamp" in msg_data:
-                        content_to_timestamps_map[text_content].append(msg_data.get("timestamp"))
-
         last_user_message_idx = -1
         for i in range(len(messages_to_send) - 1, -1, -1):
             if messages_to_send[i].get("role") == "user":
                 last_user_message_idx = i; break
 
-        last_processed_date: Optional[datetime.date] = None
-        for i, message in enumerate(messages_to_send):
-            if message.get("role") == "user":
-                content = message.get("content")
-                text_content = self._get_text_from_content(content)
-                if text_content.strip().startswith("["): continue
+        # 用户消息的摘要；已经以 "[" 开头的消息保持不变
+        if self._should_offload(len(messages_to_send)):
+            digests, bracketed, fingerprints = await self._offload(_digest_user_messages, messages_to_send)
+        else:
+            digests, bracketed, fingerprints = _digest_user_messages(messages_to_send)
+        if metrics:
+            metrics.observe("chat_messages", "", len(messages_to_send), _Metrics.SIZE_BUCKETS)
+            stage_started = metrics.lap("prepare", stage_started)
+        jwt_token = self._extract_jwt_from_request(__request__)
+        user_key = self._user_key(__user__, jwt_token)
+        if metrics: stage_started = metrics.lap("token", stage_started)
+
+        # 对话开头未变化的部分直接复用之前轮次的结果。只有其后一条用户消息的指纹不变时才复用，
+        # 该指纹涵盖消息本身、助手回复以及之前的全部内容
+        user_indices = list(digests)
+        state_key = (user_key, chat_id)
+        state = self._injection_states.get(state_key) if self.valves.incremental_injection else None
+        resumed = 0
+        if state is not None and state["timezone"] == user_timezone_str and state["date_format"] == self.valves.date_format:
+            state_chains = state["chains"]
+            limit = min(len(state_chains), len(user_indices) - 1)
+            while resumed < limit and state_chains[resumed] == fingerprints[user_indices[resumed + 1]]:
+                resumed += 1
+        pending = user_indices[resumed:]
+
+        # 本 Filter 在之前轮次注入的时间戳，以分支指纹为键（有歧义时为 None）
+        ledger = self._get_ledger()
+        ledger_timestamps: Dict[bytes, Optional[float]] = {}
+        if ledger:
+            try:
+                ledger_timestamps = await asyncio.to_thread(ledger.lookup, user_key, chat_id)
+            except Exception as e:
+                LOGGER.warning(f"读取时间戳台账失败: {e}")
+                ledger = None
 
-                current_dt = None
-                if i == last_user_message_idx:
-                    current_dt = datetime.datetime.now(tz)
+        needed = [i for i in pending if i != last_user_message_idx and i not in bracketed]
+        wanted = Counter(digests[i] for i in needed if ledger_timestamps.get(fingerprints[i]) is None)
+        # 两个分支上的文本可能完全相同，因此复用的消息要与历史中的消息 id 核对。请求带有 id（已计入指纹）或台账已记录
+        # 所有复用的消息时无需核对；否则即使本轮不需要历史的其他内容也会获取一次
+        verify = resumed > 0 and not all(messages_to_send[i].get("id") for i in user_indices[:resumed]) and not (ledger and all(ledger_timestamps.get(fingerprints[i]) is not None for i in user_indices[:resumed] if i not in bracketed))
+        if metrics: stage_started = metrics.lap("resume", stage_started)
+
+        # 对于已有对话，为台账无法确定的消息获取历史（或复用缓存），然后注入时间
+        timestamp_index = _TimestampIndex()
+        history_messages: Dict[str, Tuple[Any, bytes]] = {}
+        aligned: Optional[List[str]] = None
+        if wanted or verify:
+            budget = self.valves.history_latency_budget
+            try:
+                history = await asyncio.wait_for(self._load_chat_history(chat_id, __user__, jwt_token, __event_emitter__), timeout=budget if budget > 0 else None)
+            except asyncio.TimeoutError:
+                LOGGER.warning(f"聊天历史未能在 {budget} 秒内获取，只为无需历史的消息添加时间。")
+                history = {"messages": {}}
+            except _CircuitOpen:
+                if self.valves.debug_print_request: LOGGER.info("多次失败后已暂停获取历史，只为无需历史的消息添加时间。")
+                history = {"messages": {}}
+            if not history:
+                # 获取失败与超时的处理相同，而不是让当前消息也不带时间
+                LOGGER.warning("获取聊天历史失败，只为无需历史的消息添加时间。")
+                history = {"messages": {}}
+            if metrics: stage_started = metrics.lap("history", stage_started)
+            if self.valves.debug_print_request: LOGGER.info(f"历史缓存: {self._history_cache.stats()}")
+            history_messages = history["messages"]
+            branch = self._active_branch_user_ids(history) if history_messages else None
+            # 除非消息被增删，当前分支的用户消息 id 与请求中的用户消息按位置一一对应
+            if branch is not None and len(branch) >= len(user_indices) - 1: aligned = branch
+            if verify and history_messages:
+                state_ids = state["ids"]
+                verified = 0
+                while aligned is not None and verified < resumed and state_ids[verified] == aligned[verified]:
+                    verified += 1
+                if verified < resumed:
+                    resumed = verified
+                    pending = user_indices[resumed:]
+                    needed = [i for i in pending if i != last_user_message_idx and i not in bracketed]
+            if history_messages and needed:
+                # 仍位于分支中原位置的已确定消息无需索引即可排除其时间戳
+                skip = 0
+                while aligned is not None and skip < resumed and history_messages[aligned[skip]][1] == digests[user_indices[skip]]:
+                    skip += 1
+                resolved = [None if i in bracketed else digests[i] for i in user_indices[:resumed]]
+                index_args = (history, Counter(digests[i] for i in needed), branch, resolved, skip)
+                if self._should_offload(len(history.get("parents") or history_messages)):
+                    timestamp_index = await self._offload(self._build_timestamp_index, *index_args)
                 else:
-                    timestamp_queue = content_to_timestamps_map.get(text_content)
-                    if timestamp_queue:
-                        timestamp = timestamp_queue.pop(0)
-                        current_dt = datetime.datetime.fromtimestamp(timestamp, tz)
-                    else: continue
-                
-                if not current_dt: continue
+                    timestamp_index = self._build_timestamp_index(*index_args)
+            if metrics: stage_started = metrics.lap("index", stage_started)
 
-                use_full_format = (last_processed_date is None) or (current_dt.date() != last_processed_date)
-                time_prefix = self.get_time_prefix(current_dt, use_full_format)
+        new_ledger_entries: List[Tuple[bytes, float]] = []
+        resolved_chains: List[bytes] = state["chains"][:resumed] if resumed else []
+        resolved_ids: List[Optional[str]] = state["ids"][:resumed] if resumed else []
+        resolved_prefixes: List[Optional[str]] = state["prefixes"][:resumed] if resumed else []
+        resolved_dates: List[Optional[datetime.date]] = state["dates"][:resumed] if resumed else []
+        resolved_times: List[Optional[datetime.datetime]] = state["times"][:resumed] if resumed else []
+        compacting = self.valves.prefix_compaction != "off" or self.valves.prefix_token_budget > 0
+        stamped: List[Tuple[int, datetime.datetime]] = [(i, dt) for i, dt in zip(user_indices, resolved_times) if dt is not None]
+        if not compacting:
+            for i, time_prefix in zip(user_indices, resolved_prefixes):
+                if time_prefix is not None: self._apply_time_prefix(messages_to_send[i], time_prefix)
 
-                if isinstance(content, str):
-                    message["content"] = f"{time_prefix}\n{content}"
-                elif isinstance(content, list):
-                    text_part_found = False
-                    for part in content:
-                        if part.get("type") == "text":
-                            part["text"] = f"{time_prefix}\n{part.get('text', '')}"; text_part_found = True; break
-                    if not text_part_found:
-                        content.insert(0, {"type": "text", "text": f"{time_prefix}\n"})
-
-                last_processed_date = current_dt.date()
+        # 没有时间戳的消息会在下一轮重试，因此不记住它之后的任何结果
+        # 先确定待处理消息的时间戳，再一次性转换为本地时间
+        pending_timestamps: List[Optional[float]] = []
+        for i in pending:
+            timestamp = None
+            if i in bracketed: pass
+            elif i == last_user_message_idx:
+                timestamp = time.time()
+            else:
+                timestamp = timestamp_index.pop(digests[i])
+                known_message = history_messages.get(messages_to_send[i].get("id"))
+                if known_message is not None: timestamp = known_message[0]
+                # 已获取的历史优先；台账只补充历史无法确定的消息
+                if timestamp is None: timestamp = ledger_timestamps.get(fingerprints[i])
+            pending_timestamps.append(timestamp)
+
+        unresolved = False
+        last_processed_date: Optional[datetime.date] = resolved_dates[-1] if resolved_dates else None
+        for i, timestamp, current_dt in zip(pending, pending_timestamps, formatter.localize(pending_timestamps)):
+            time_prefix = None
+            if i not in bracketed:
+                if current_dt is not None:
+                    if ledger and _TimestampLedger.should_record(ledger_timestamps, fingerprints[i], timestamp): new_ledger_entries.append((fingerprints[i], timestamp))
+                    current_date = current_dt.date()
+                    time_prefix = formatter.prefix(current_dt, current_date != last_processed_date)
+                    if compacting: stamped.append((i, current_dt))
+                    else: self._apply_time_prefix(messages_to_send[i], time_prefix)
+                    last_processed_date = current_date
+                else:
+                    unresolved = True
+
+            if i != last_user_message_idx and not unresolved:
+                position = len(resolved_chains)
+                resolved_chains.append(fingerprints[user_indices[position + 1]])
+                resolved_ids.append(aligned[position] if aligned is not None and history_messages[aligned[position]][1] == digests[i] else None)
+                resolved_prefixes.append(time_prefix)
+                resolved_dates.append(last_processed_date)
+                resolved_times.append(current_dt if time_prefix is not None else None)
+        if compacting:
+            for i, time_prefix in self._compact_prefixes(formatter, stamped, last_user_message_idx):
+                self._apply_time_prefix(messages_to_send[i], time_prefix)
+        if metrics: stage_started = metrics.lap("inject", stage_started)
+
+        if self.valves.incremental_injection:
+            self._injection_states.put(state_key, {"timezone": user_timezone_str, "date_format": self.valves.date_format, "chains": resolved_chains, "ids": resolved_ids, "prefixes": resolved_prefixes, "dates": resolved_dates, "times": resolved_times}, self.valves.history_cache_max_chats)
+            if self.valves.debug_print_request: LOGGER.info(f"增量注入复用了 {len(user_indices)} 条用户消息中的 {resumed} 条。")
+
+        if ledger and new_ledger_entries:
+            await self._record_in_ledger(ledger, user_key, chat_id, new_ledger_entries)
+
+        if metrics:
+            metrics.lap("save", stage_started)
+            metrics.observe("stage_seconds", "total", time.perf_counter() - started)
+            self._log_metrics()
 
         if self.valves.debug_print_request:
             LOGGER.info(f"最终发送给模型的 Messages 列表:\n{json.dumps(messages_to_send, indent=2, ensure_ascii=False)}")